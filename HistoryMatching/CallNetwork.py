@@ -1,4 +1,37 @@
+import os
 import numpy as np
+
+# Loaded models of the process: (path, variant) -> (key with the file mtimes, graph, model)
+_MODEL_CACHE = {}
+
+def ModelKey(model_name):
+    files = [model_name + '.json', model_name + '_weights.hdf5']
+    return (os.path.abspath(model_name),) + tuple(os.path.getmtime(f) for f in files if os.path.exists(f))
+
+def GetModel(model_name, load, variant=None):
+    # Loads model_name with load(model_name) once per process; reloads it when its files change
+    # or when the keras graph was replaced (K.clear_session). variant: the loader options
+    # (e.g. custom_objects), models loaded with different options are cached apart
+    import keras.backend as K
+    key = ModelKey(model_name)
+    graph = K.get_session().graph
+    cached = _MODEL_CACHE.get((key[0], variant))
+    if cached is None or cached[0] != key or cached[1] is not graph:
+        _MODEL_CACHE[(key[0], variant)] = (key, graph, load(model_name))
+    return _MODEL_CACHE[(key[0], variant)][2]
+
+def ClearModelCache(model_name=None):
+    # Evicts model_name (every variant, or every model); the Keras session is cleared once the cache is empty
+    import keras.backend as K
+    if model_name is None:
+        _MODEL_CACHE.clear()
+    else:
+        for name in [name for name in _MODEL_CACHE if name[0] == os.path.abspath(model_name)]:
+            del _MODEL_CACHE[name]
+    if not _MODEL_CACHE:
+        K.get_session().close()
+        K.clear_session()
+
 def CVAE_function(data,dimention_x,dimention_y,comandoEndoder='Encoder',redeVAE='CVAE45(sig)'):
     from keras.models import model_from_json
     from keras.utils import to_categorical
@@ -22,8 +55,8 @@ def CVAE_function(data,dimention_x,dimention_y,comandoEndoder='Encoder',redeVAE=
             # load weights into new model
             loaded_model.load_weights(weights_path)        
             return loaded_model
-        encoder=load(name+"_encoder")
-        Decoder=load(name+"_decoder")
+        encoder=GetModel(name+"_encoder",load,'CVAE_function')
+        Decoder=GetModel(name+"_decoder",load,'CVAE_function')
         return encoder,Decoder
 
     encoder,decoder=load_AE(redeVAE)
@@ -46,5 +79,4 @@ def CVAE_function(data,dimention_x,dimention_y,comandoEndoder='Encoder',redeVAE=
         #Plot_Result(x_decoded,x_decoded)
 
     #sio.savemat(output,{'Result': x_out})
-    K.clear_session()
     return x_out.T
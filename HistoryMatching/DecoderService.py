@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import io
+import socket
+import struct
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Local decoding service: one loaded ModelDL serves many ES-MDA processes.
+Requests (latent vectors or facies of several members) arriving within a small
+time window are batched along the members axis and run in one predict call.
+Protocol over TCP: header (op b'd' decode / b'e' encode, length) then the array
+in .npy format; the answer is (b'o' ok / b'x' error, length) then the .npy array
+or the error message.
+"""
+
+HEADER = struct.Struct('!cQ')
+
+
+def ToBytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def FromBytes(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def ReceiveAll(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError('Connection closed by the decoder service')
+        data.extend(chunk)
+    return bytes(data)
+
+
+class DecoderService:
+    """
+    model: ModelDL (or any object with predict(data, is_update)).
+    window: time in s waiting for other requests after the first one of a batch.
+    max_batch: maximum number of members of a batched predict.
+    """
+    def __init__(self, model, host='127.0.0.1', port=0, window=0.005, max_batch=2000):
+        self.model = model
+        self.host = host
+        self.port = port
+        self.window = window
+        self.max_batch = max_batch
+        self.loop = None
+        self.thread = None
+        self.queue = None
+        self.server = None
+        self.batches = []
+        self.handlers = set()
+        # predict runs in one thread, out of the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def handle(self, reader, writer):
+        # Tracked so that stop() can end the open connections
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        try:
+            while True:
+                op, size = HEADER.unpack(await reader.readexactly(HEADER.size))
+                payload = await reader.readexactly(size)
+                try:
+                    data = FromBytes(payload)
+                    if data.ndim != 2:
+                        raise ValueError('Expected an array (features, members), got shape %s' % (data.shape, ))
+                    future = self.loop.create_future()
+                    await self.queue.put((data, op == b'd', future))
+                    answer = b'o', ToBytes(await future)
+                except Exception as exc:
+                    answer = b'x', ('%s: %s' % (type(exc).__name__, exc)).encode()
+                writer.write(HEADER.pack(answer[0], len(answer[1])) + answer[1])
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.handlers.discard(task)
+            writer.close()
+
+    async def batcher(self):
+        waiting = []
+        while True:
+            first = waiting.pop(0) if waiting else await self.queue.get()
+            batch = [first]
+            # Any failure (assembly or predict) goes to the futures of the batch, the batcher keeps serving
+            try:
+                same = [request[1] == first[1] and request[0].shape[0] == first[0].shape[0] for request in waiting]
+                batch += [request for request, keep in zip(waiting, same) if keep]
+                waiting = [request for request, keep in zip(waiting, same) if not keep]
+                size = sum(request[0].shape[1] for request in batch)
+                deadline = self.loop.time() + self.window
+                while size < self.max_batch:
+                    timeout = deadline - self.loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    # Other kinds of requests are kept for the next batch
+                    if request[1] != first[1] or request[0].shape[0] != first[0].shape[0]:
+                        waiting.append(request)
+                        continue
+                    batch.append(request)
+                    size += request[0].shape[1]
+
+                data = np.concatenate([request[0] for request in batch], axis=1)
+                result = await self.loop.run_in_executor(self.executor, self.model.predict, data, first[1])
+                self.batches.append(len(batch))
+                start = 0
+                for request in batch:
+                    members = request[0].shape[1]
+                    if not request[2].done():
+                        request[2].set_result(result[:, start:start + members])
+                    start += members
+            except Exception as exc:
+                for request in batch:
+                    if not request[2].done():
+                        request[2].set_exception(exc)
+
+    async def serve(self, started=None):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        batcher = self.loop.create_task(self.batcher())
+        if started is not None:
+            started.set()
+        try:
+            await self.server.wait_closed()
+        finally:
+            batcher.cancel()
+
+    def shutdown(self):
+        # In the event loop: no new connections, open ones are cancelled (their writers closed)
+        self.server.close()
+        for task in list(self.handlers):
+            task.cancel()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def start(self):
+        """Serves in a background thread, returns (host, port)"""
+        started = threading.Event()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve(started)), daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.host, self.port
+
+    def stop(self):
+        if self.server is not None:
+            self.loop.call_soon_threadsafe(self.shutdown)
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.executor.shutdown()
+
+
+class DecoderClient:
+    """Same predict interface as ModelDL, can replace redeVAE in Contitional_ES_MDA"""
+    def __init__(self, host='127.0.0.1', port=5757):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def predict(self, data, is_update=True):
+        payload = ToBytes(np.asarray(data, dtype='float32'))
+        self.sock.sendall(HEADER.pack(b'd' if is_update else b'e', len(payload)) + payload)
+        status, size = HEADER.unpack(ReceiveAll(self.sock, HEADER.size))
+        answer = ReceiveAll(self.sock, size)
+        if status != b'o':
+            raise RuntimeError('Decoder service: ' + answer.decode())
+        return FromBytes(answer)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# python -m HistoryMatching.DecoderService --redePath Model/TrainModel/CVAE100 --model_dim 100-100-1 --port 5757
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Local facies decoding service",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--redePath", type=str, required=True,
+                        help="network path (without _encoder/_decoder)")
+    parser.add_argument("--model_dim", type=str, default='100-100-1',
+                        help="dimension of the facies model")
+    parser.add_argument("--NumFacies", type=int, default=2,
+                        help="number of facies")
+    parser.add_argument("--isTanh", action='store_true',
+                        help="encoder input scaled to [-1, 1]")
+    parser.add_argument("--port", type=int, default=5757,
+                        help="port of the service (localhost)")
+    parser.add_argument("--window", type=float, default=0.005,
+                        help="batching window in s")
+    parser.add_argument("--max_batch", type=int, default=2000,
+                        help="maximum number of members of a batch")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    from HistoryMatching.ModelDL import ModelDL
+    args = get_args()
+    model = {'redePath': args.redePath, 'PCA': False, 'IsGans': False, 'toCategorical': True,
+             'Model_Dim': tuple(int(i) for i in args.model_dim.split('-')),
+             'NumFacies': args.NumFacies, 'isTanh': args.isTanh}
+    service = DecoderService(ModelDL(model), port=args.port, window=args.window, max_batch=args.max_batch)
+    print('Decoder service on %s:%i' % (service.host, service.port))
+    service.serve_forever()
+
+if __name__ == '__main__':
+    main()
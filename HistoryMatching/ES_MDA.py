@@ -1,16 +1,16 @@
 import pandas as pd
 import numpy as np
-from scipy import array, linalg, dot
+from scipy import array, linalg, dot, sparse
 import math
 import tensorflow as tf
 # Set up eager mode.
 #tf.enable_eager_execution()
 
 """
-ES-MDA class implementation with tensorflow
+ES-MDA implementations: ESMDA_NP (numpy) and ESMDA_TF (compiled tensorflow kernel)
 """
 class ESMDA: 
-    def __init__(self, N_ens, N_obs, N_m, numsave=2, hasU =False, sess=None, isLoc=False):
+    def __init__(self, N_ens, N_obs, N_m, numsave=2, hasU =False, sess=None, isLoc=False, solver='data', chunk_size=None, use_tf=False):
         self.N = N_ens
         self.N_m = N_m
         self.N_obs = N_obs
@@ -19,125 +19,286 @@ class ESMDA:
         self.decimal = 1-1/math.pow(10, numsave)
         self.isLoc = isLoc
         self.hasU = hasU
-        if self.sess is not None:
-            self.Create_grahp()
-
-    def Create_grahp(self):
-        with tf.device("/cpu:0"):
-            self.ph_N = tf.placeholder(tf.float32, name='N')
-            self.ph_y_f = tf.placeholder(tf.float32, [self.N_m, self.N], name='y_f')
-            self.ph_d_f = tf.placeholder(tf.float32, [self.N_obs, self.N], name='d_f')
-            self.ph_Z = tf.placeholder(tf.float32, [self.N_obs, 1], name='Z')
-            self.ph_CD = tf.placeholder(tf.float32, [self.N_obs, self.N_obs], name='R')
-            self.ph_alpha = tf.placeholder(tf.float32, name='Alpha')
-            
-            self.corr_t = tf.placeholder(tf.float32, [self.N_m, self.N_obs], name='corr')
-
-            if self.hasU :            
-                self.ph_U = tf.placeholder(tf.float32, [self.N_obs, self.N_obs], name='U')
-                U_t = self.ph_U
+        # 'data': inversion in the N_obs x N_obs space, 'subspace': in the N_ens x N_ens space
+        self.solver = solver
+        self.chunk_size = chunk_size
+        # The compiled tensorflow kernel is used when requested or when a session is given
+        self.use_tf = use_tf or sess is not None
+        self.engine = None
+
+    def Compute(self, m_ens, Z, prod_ens, alpha, CD, corr=[], U=None):
+        if self.engine is None or self.engine.CD is not CD:
+            if self.use_tf:
+                self.engine = ESMDA_TF(CD, self.numsave, U, solver=self.solver, isLoc=self.isLoc, sess=self.sess)
             else:
-                R_t = tf.linalg.cholesky(self.ph_CD)
-                U_t = tf.transpose(R_t)
+                self.engine = ESMDA_NP(CD, self.numsave, U, solver=self.solver, chunk_size=self.chunk_size)
+        return self.engine.Analysis(m_ens, Z, prod_ens, alpha, corr if self.isLoc else [])
+
+def ES_MDA(num_ens,m_ens,Z,prod_ens,alpha,CD,corr,numsave=2,chunk_size=None):
+    return ESMDA_NP(CD, numsave, chunk_size=chunk_size).Analysis(m_ens, Z, prod_ens, alpha, corr)
+
+# State rows updated at once by a localized analysis when chunk_size is not given
+LOCALIZED_CHUNK = 1000
 
 
-            y_m = tf.expand_dims(tf.reduce_mean(self.ph_y_f, axis=1), axis=-1)
-            d_m = tf.expand_dims(tf.reduce_mean(self.ph_d_f, axis=1), axis=-1)
-            delta_m_f = self.ph_y_f - y_m
-            delta_d_f = self.ph_d_f - d_m
-            Cdd_ft = tf.matmul(delta_d_f, delta_d_f, transpose_b=True)/(self.ph_N - 1)
-            Cmd_ft = tf.matmul(delta_m_f, delta_d_f, transpose_b=True)/(self.ph_N - 1)
+def IsLocalized(corr):
+    return corr is not None and (sparse.issparse(corr) or len(corr) > 0)
 
-            Z_exp = tf.tile(self.ph_Z, tf.constant([1, self.N]))
-            mean_t = tf.zeros_like(tf.transpose(Z_exp))
 
+def CorrRows(corr, rows):
+    # Rows of a dense, sparse or Localization (HistoryMatching.Localization) matrix as a dense array
+    corr = corr[rows]
+    return corr.toarray() if sparse.issparse(corr) else corr
 
 
-            noise_t = tf.random.normal(mean_t.shape, mean=0.0, stddev=1.0)
-            d_obs_t = tf.add(Z_exp, tf.math.sqrt(self.ph_alpha)*tf.matmul(U_t, noise_t, transpose_b=True))
+class ESMDA_NP:
+    """
+    ES-MDA analysis step in numpy. The factorization of CD is computed once
+    and reused by every call to Analysis (one call per alpha step).
+    CD can be the full (N_obs, N_obs) matrix or the vector of its diagonal.
 
-            # Analysis step
-            cdd_t = tf.add(Cdd_ft, self.ph_alpha*self.ph_CD)
+    solver='data' inverts (Cdd_f + alpha*CD) in the N_obs x N_obs space (truncated
+    with numsave), solver='subspace' uses the Woodbury identity on the scaled data
+    anomalies so the cost grows with N_ens instead of N_obs.
 
-            fixed_tf_matrix = tf.cast(cdd_t, tf.float64)          
-            s_t, u_t, vh_t = tf.linalg.svd(fixed_tf_matrix)   # CPU bether
-            v_t = tf.cast(vh_t, tf.float32) 
-            s_t = tf.cast(s_t, tf.float32)
-            u_t = tf.cast(u_t, tf.float32)
+    chunk_size bounds the number of state rows updated at once (None: all rows, or
+    LOCALIZED_CHUNK rows with localization). corr may be a dense array, a scipy sparse
+    matrix or a Localization object; only chunk_size rows of it are made dense at a time.
+    """
+    def __init__(self, CD, numsave=2, U=None, seed=None, solver='data', chunk_size=None):
+        if solver not in ('data', 'subspace'):
+            raise ValueError("solver must be 'data' or 'subspace'")
+        self.solver = solver
+        self.chunk_size = chunk_size
+        self.numsave = numsave
+        self.decimal = 1-1/math.pow(10, numsave)
+        self.rng = np.random.RandomState(seed)
+        self.CD = CD
+        CD = np.asarray(CD)
+        if CD.ndim == 1:
+            self.isDiag = True
+            var = CD
+        else:
+            var = np.diagonal(CD)
+            self.isDiag = np.count_nonzero(CD - np.diag(var)) == 0
+        self.var = var.reshape(-1, 1)
+        self.std = np.sqrt(self.var)
+        self.N_obs = self.var.shape[0]
+        # Lower Cholesky factor of CD (None when CD is diagonal)
+        self.chol = None if self.isDiag else linalg.cholesky(CD, lower=True)
+        # Noise factor: U given by the user or the Cholesky factor
+        self.L = self.chol if U is None else np.asarray(U)
+        self.CD_full = None if self.isDiag else CD
 
-            #s_t, u_t, vh_t = tf.linalg.svd(cdd_t)   # CPU bether
-            #v_t = vh_t
-            CC = int(self.N_obs*self.decimal)
+    def Perturb(self, Z, num_ens, alpha):
+        noise = self.rng.standard_normal((self.N_obs, num_ens))
+        if self.L is None:
+            noise *= self.std
+        else:
+            noise = np.dot(self.L, noise)
+        return Z.reshape(-1, 1) + math.sqrt(alpha)*noise
 
-            zero = tf.constant(0, dtype=tf.float32)
-            where = tf.not_equal(s_t, zero)
-            index_non_zero = tf.where(where)
-            cc_ = tf.shape(tf.boolean_mask(s_t, index_non_zero))[0]
+    def Truncate(self, s):
+        # Number of singular values holding the fraction 'decimal' of the spectrum
+        cumsum = np.cumsum(s)
+        nz = np.searchsorted(cumsum/cumsum[-1], self.decimal, side='right') + 1
+        return min(nz, len(s))
 
-            diagonal_t = s_t[:cc_]
-            u_t = u_t[:, :cc_]
-            v_t = v_t[:, :cc_]
-            s_rt = tf.linalg.diag(tf.math.pow(diagonal_t, -1))
-            K_t = tf.matmul(Cmd_ft, (tf.matmul(tf.matmul(v_t, s_rt), u_t, transpose_b= True)))
+    def Factorize(self, ddf, alpha):
+        """Returns a function applying (Cdd_f + alpha*CD)^-1 to a (N_obs, k) matrix"""
+        if self.solver == 'subspace':
+            return self.FactorizeSubspace(ddf, alpha)
+        num_ens = ddf.shape[1]
+        C = np.dot(ddf, ddf.T)/(num_ens-1)
+        if self.isDiag:
+            C[np.diag_indices_from(C)] += alpha*self.var[:, 0]
+        else:
+            C += alpha*self.CD_full
+        # C is symmetric positive definite: eigh gives the SVD at a fraction of the cost
+        s, u = linalg.eigh(C, overwrite_a=True, check_finite=False)
+        s, u = s[::-1], u[:, ::-1]
+        nz = self.Truncate(s)
+        u = u[:, :nz]
+        s_inv = (1/s[:nz]).reshape(-1, 1)
+        return lambda rhs: np.dot(u, s_inv*np.dot(u.T, rhs))
 
-            if self.isLoc:
-                K_t = tf.math.multiply(self.corr_t, K_t)
-            self.m_ens_t = self.ph_y_f + tf.matmul(K_t, tf.subtract(d_obs_t, self.ph_d_f)) 
+    def ScaleCD(self, x, transpose=False):
+        """Applies L^-1 (or L^-T) where L L^T = CD"""
+        if self.chol is None:
+            return x/self.std
+        return linalg.solve_triangular(self.chol, x, lower=True, trans=1 if transpose else 0, check_finite=False)
 
-    def Compute(self, m_ens, Z, prod_ens, alpha, CD, corr=[], U=None):
-        if not self.isLoc:
-            corr = np.zeros([self.N_m, self.N_obs])
-        if self.sess is not None:
-            if  U is None:
-                return self.sess.run(self.m_ens_t, feed_dict={self.ph_alpha: alpha, self.ph_d_f: prod_ens, self.ph_CD: CD, self.ph_y_f:m_ens,self.ph_Z:Z,self.ph_N : self.N,self.corr_t:corr})
-            return self.sess.run(self.m_ens_t, feed_dict={self.ph_alpha: alpha, self.ph_d_f: prod_ens, self.ph_CD: CD, self.ph_y_f:m_ens,self.ph_Z:Z,self.ph_N : self.N, self.ph_U: U ,self.corr_t:corr})
-        
-        return ES_MDA(self.N, m_ens, Z, prod_ens, alpha, CD, corr, self.numsave, U)
-
-def ES_MDA(num_ens,m_ens,Z,prod_ens,alpha,CD,corr,numsave=2):
-    varn=1-1/math.pow(10,numsave)
-    # Initial Variavel 
-    # Forecast step
-    yf = m_ens                        # Non linear forward model 
-    df = prod_ens                     # Observation Model
-    numsave
-    ym = np.array(yf.mean(axis=1))    # Mean of the y_f
-    dm = np.array(df.mean(axis=1))    # Mean of the d_f
-    ym=ym.reshape(ym.shape[0],1)    
-    dm=dm.reshape(dm.shape[0],1)    
-    dmf = yf - ym
-    ddf = df - dm
-    
-    Cmd_f = (np.dot(dmf,ddf.T))/(num_ens-1);  # The cros-covariance matrix
-    Cdd_f = (np.dot(ddf,ddf.T))/(num_ens-1);  # The auto covariance of predicted data
-    
-    # Perturb the vector of observations
-    R = linalg.cholesky(CD,lower=True) #Matriz triangular inferior
-    U = R.T   #Matriz R transposta
-    p , w =np.linalg.eig(CD)
-    
-    aux = np.repeat(Z,num_ens,axis=1)
-    mean = 0*(Z.T)
-
-    noise=np.random.multivariate_normal(mean[0], np.eye(len(Z)), num_ens).T
-    d_obs = aux+math.sqrt(alpha)*np.dot(U,noise)  
-    
-    # Analysis step
-    u, s, vh = linalg.svd(Cdd_f+alpha*CD); v = vh.T
-    diagonal = s
-    for i in range(len(diagonal)):
-        if (sum(diagonal[0:i+1]))/(sum(diagonal)) > varn:
-            diagonal = diagonal[0:i+1]
-            break
-    
-    u=u[:,0:i+1]
-    v=v[:,0:i+1]
-    ss = np.diag(diagonal**(-1))
-    K=np.dot(Cmd_f,(np.dot(np.dot(v,ss),(u.T))))
-    # Use Kalman covariance
-    if len(corr)>0:
-        K = corr*K
-        
-    ya = yf + (np.dot(K,(d_obs-df)))
-    m_ens = ya
-    return m_ens
+    def Misfit(self, prod_ens, Z):
+        """Normalized data mismatch of each member, mean of ((d - Z)/sigma)^2 (about 1 at the noise level)"""
+        r = self.ScaleCD(prod_ens - Z.reshape(-1, 1))
+        return (r**2).mean(axis=0)
+
+    def InflationLM(self, prod_ens, Z, rho=0.2, alpha_min=1.0):
+        """
+        Smallest alpha >= alpha_min for which the linearized update keeps at least the
+        fraction rho of the scaled data residual of the ensemble mean (regularizing
+        Levenberg-Marquardt rule)
+        """
+        num_ens = prod_ens.shape[1]
+        d_mean = prod_ens.mean(axis=1, keepdims=True)
+        r = self.ScaleCD(Z.reshape(-1, 1) - d_mean)[:, 0]
+        S = self.ScaleCD(prod_ens - d_mean)/math.sqrt(num_ens-1)
+        u, s, _ = linalg.svd(S, full_matrices=False, check_finite=False)
+        c2 = np.dot(u.T, r)**2
+        target = rho**2*np.dot(r, r)
+
+        # Squared norm of the predicted residual alpha*CD*(C + alpha*CD)^-1 r, increasing in alpha
+        residual = lambda alpha: np.dot(r, r) - np.sum((1 - (alpha/(s**2 + alpha))**2)*c2)
+        if residual(alpha_min) >= target:
+            return alpha_min
+        low, high = alpha_min, 2*alpha_min
+        while residual(high) < target:
+            low, high = high, 2*high
+        for i in range(50):
+            alpha = math.sqrt(low*high)
+            if residual(alpha) < target:
+                low = alpha
+            else:
+                high = alpha
+        return high
+
+    def FactorizeSubspace(self, ddf, alpha):
+        # (Cdd_f + alpha*CD)^-1 = (1/alpha) L^-T (I - U diag(s^2/(1+s^2)) U^T) L^-1
+        # with U s V^T the thin SVD of L^-1 ddf / sqrt((N_ens-1)*alpha)
+        num_ens = ddf.shape[1]
+        G = self.ScaleCD(ddf)/math.sqrt((num_ens-1)*alpha)
+        u, s, _ = linalg.svd(G, full_matrices=False, overwrite_a=True, check_finite=False)
+        w = (s**2/(1 + s**2)).reshape(-1, 1)
+
+        def solve(rhs):
+            y = self.ScaleCD(rhs)
+            y -= np.dot(u, w*np.dot(u.T, y))
+            return self.ScaleCD(y, transpose=True)/alpha
+        return solve
+
+    def Analysis(self, m_ens, Z, prod_ens, alpha, corr=[], out=None):
+        """
+        Updates m_ens (N_m, N_ens) without forming the Kalman gain: the update is
+        dmf @ (ddf^T @ W) / (N_ens-1) with W = C^-1 (d_obs - d_f), computed over
+        chunk_size rows of the state at a time. The result is written in out
+        (a preallocated array, an np.memmap or m_ens itself) when given.
+        """
+        num_ens = prod_ens.shape[1]
+        N_m = m_ens.shape[0]
+        df = prod_ens
+        ddf = df - df.mean(axis=1, keepdims=True)
+
+        d_obs = self.Perturb(Z, num_ens, alpha)
+        solve = self.Factorize(ddf, alpha)
+        innovation = d_obs - df
+        if IsLocalized(corr):
+            X = None
+        else:
+            X = np.dot(ddf.T, solve(innovation))/(num_ens-1)
+
+        if out is None:
+            out = np.empty((N_m, num_ens), dtype=np.result_type(m_ens, np.float32))
+        # Localized: the taper and gain rows are dense, never all N_m rows at once
+        chunk = self.chunk_size or (LOCALIZED_CHUNK if X is None else N_m)
+        for start in range(0, N_m, chunk):
+            rows = slice(start, min(start + chunk, N_m))
+            yf = np.asarray(m_ens[rows])
+            dmf = yf - yf.mean(axis=1, keepdims=True)
+            if X is None:
+                # Localized gain rows: K = corr * (C^-1 Cmd_f^T)^T
+                K = CorrRows(corr, rows)*solve(np.dot(ddf, dmf.T)/(num_ens-1)).T
+                out[rows] = yf + np.dot(K, innovation)
+            else:
+                out[rows] = yf + np.dot(dmf, X)
+        return out
+
+
+class ESMDA_TF:
+    """
+    ES-MDA analysis step compiled once with tf.function and reused for every
+    alpha step (the ensemble and alpha are inputs of the kernel, with unknown
+    dimensions, so it is never re-traced). CD is factorized once by ESMDA_NP,
+    which also draws the observation noise, and the whole kernel runs in dtype.
+
+    Runs eagerly without a session (TF 2 or tf.enable_eager_execution()); in
+    TF1 graph mode the kernel is instantiated once on placeholders and
+    evaluated with sess.
+    """
+    def __init__(self, CD, numsave=2, U=None, seed=None, solver='data', isLoc=False, dtype='float64', sess=None):
+        self.factor = ESMDA_NP(CD, numsave, U, seed=seed, solver=solver)
+        self.CD = CD
+        self.solver = solver
+        self.isLoc = isLoc
+        self.decimal = self.factor.decimal
+        self.dtype = tf.as_dtype(dtype)
+
+        self.std_t = tf.constant(self.factor.std, dtype=self.dtype)
+        self.var_t = tf.constant(self.factor.var[:, 0], dtype=self.dtype)
+        if self.factor.isDiag:
+            self.chol_t = None
+        else:
+            self.chol_t = tf.constant(self.factor.chol, dtype=self.dtype)
+            self.CD_t = tf.constant(self.factor.CD_full, dtype=self.dtype)
+
+        matrix = tf.TensorSpec([None, None], self.dtype)
+        signature = [matrix, matrix, matrix, tf.TensorSpec([], self.dtype)]
+        if isLoc:
+            signature.append(matrix)
+        self.kernel = tf.function(self.Update, input_signature=signature)
+
+        self.sess = None
+        if not tf.executing_eagerly():
+            self.placeholders = [tf.placeholder(self.dtype, spec.shape) for spec in signature]
+            self.m_ens_t = self.kernel(*self.placeholders)
+            self.sess = sess if sess is not None else tf.Session()
+
+    def ScaleCD(self, x, transpose=False):
+        if self.chol_t is None:
+            return x/self.std_t
+        return tf.linalg.triangular_solve(self.chol_t, x, lower=True, adjoint=transpose)
+
+    def Factorize(self, ddf, alpha, N):
+        if self.solver == 'subspace':
+            G = self.ScaleCD(ddf)/tf.math.sqrt((N - 1)*alpha)
+            s, u, _ = tf.linalg.svd(G)
+            w = tf.expand_dims(tf.square(s)/(1 + tf.square(s)), axis=-1)
+
+            def solve(rhs):
+                y = self.ScaleCD(rhs)
+                y = y - tf.matmul(u, w*tf.matmul(u, y, transpose_a=True))
+                return self.ScaleCD(y, transpose=True)/alpha
+            return solve
+
+        C = tf.matmul(ddf, ddf, transpose_b=True)/(N - 1)
+        if self.chol_t is None:
+            C = tf.linalg.set_diag(C, tf.linalg.diag_part(C) + alpha*self.var_t)
+        else:
+            C = C + alpha*self.CD_t
+        s, u = tf.linalg.eigh(C)
+        s, u = tf.reverse(s, [0]), tf.reverse(u, [1])
+        cumsum = tf.cumsum(s)
+        nz = tf.reduce_sum(tf.cast(cumsum/cumsum[-1] <= self.decimal, tf.int32)) + 1
+        nz = tf.minimum(nz, tf.shape(s)[0])
+        u = u[:, :nz]
+        s_inv = tf.expand_dims(1/s[:nz], axis=-1)
+        return lambda rhs: tf.matmul(u, s_inv*tf.matmul(u, rhs, transpose_a=True))
+
+    def Update(self, y_f, d_f, d_obs, alpha, corr=None):
+        N = tf.cast(tf.shape(y_f)[1], self.dtype)
+        dmf = y_f - tf.reduce_mean(y_f, axis=1, keepdims=True)
+        ddf = d_f - tf.reduce_mean(d_f, axis=1, keepdims=True)
+        solve = self.Factorize(ddf, alpha, N)
+        innovation = d_obs - d_f
+        if corr is None:
+            X = tf.matmul(ddf, solve(innovation), transpose_a=True)/(N - 1)
+            return y_f + tf.matmul(dmf, X)
+        K = corr*tf.transpose(solve(tf.matmul(ddf, dmf, transpose_b=True)/(N - 1)))
+        return y_f + tf.matmul(K, innovation)
+
+    def Analysis(self, m_ens, Z, prod_ens, alpha, corr=[]):
+        d_obs = self.factor.Perturb(Z, prod_ens.shape[1], alpha)
+        inputs = [m_ens, prod_ens, d_obs, alpha] + ([CorrRows(corr, slice(None))] if self.isLoc else [])
+        inputs = [np.asarray(x, dtype=self.dtype.as_numpy_dtype) for x in inputs]
+        if self.sess is None:
+            return self.kernel(*inputs).numpy()
+        return self.sess.run(self.m_ens_t, feed_dict=dict(zip(self.placeholders, inputs)))
@@ -0,0 +1,100 @@
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+"""
+Forward model runner for ES-MDA: runs a simulator for every ensemble member
+(column of m_f) with a serial, thread-pool or process-pool backend.
+"""
+
+class FaciesSimulator:
+    """Stand-in simulator: facies at the well cells (index from GetFaciesIndex)"""
+    def __init__(self, index, delay=0.0):
+        self.index = np.asarray(index)
+        self.delay = delay
+
+    def __call__(self, facies):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        return np.asarray(facies)[self.index]
+
+
+def RunMember(simulator, member, facies):
+    start = time.perf_counter()
+    try:
+        data = np.ravel(simulator(facies))
+        error = None
+    except Exception as exc:
+        data = None
+        error = '%s: %s' % (type(exc).__name__, exc)
+    return member, data, time.perf_counter() - start, error
+
+
+class ForwardModel:
+    """
+    simulator: picklable callable (for backend='process') mapping one column of
+    m_f to the vector of simulated observations.
+    backend: 'serial', 'thread' or 'process'.
+    on_error: 'nan' fills the data of failed members with NaN (their indices
+    are kept in self.failed), 'raise' stops the run.
+    """
+    def __init__(self, simulator, backend='serial', workers=None, on_error='nan'):
+        if backend not in ('serial', 'thread', 'process'):
+            raise ValueError("backend must be 'serial', 'thread' or 'process'")
+        if on_error not in ('nan', 'raise'):
+            raise ValueError("on_error must be 'nan' or 'raise'")
+        self.simulator = simulator
+        self.backend = backend
+        self.workers = workers
+        self.on_error = on_error
+        self.executor = None
+        self.failed = []
+        self.errors = {}
+        self.times = np.zeros(0)
+
+    def _executor(self):
+        if self.executor is None:
+            pool = ThreadPoolExecutor if self.backend == 'thread' else ProcessPoolExecutor
+            self.executor = pool(max_workers=self.workers)
+        return self.executor
+
+    def run(self, m_f):
+        """Returns Obs_sim (N_obs, N_ens) in the order of the columns of m_f"""
+        num_ens = m_f.shape[1]
+        if self.backend == 'serial':
+            results = [RunMember(self.simulator, i, m_f[:, i]) for i in range(num_ens)]
+        else:
+            executor = self._executor()
+            futures = [executor.submit(RunMember, self.simulator, i, m_f[:, i]) for i in range(num_ens)]
+            results = [future.result() for future in futures]
+
+        self.times = np.array([elapsed for _, _, elapsed, _ in results])
+        self.errors = {member: error for member, _, _, error in results if error is not None}
+        self.failed = sorted(self.errors)
+        if self.failed and self.on_error == 'raise':
+            member = self.failed[0]
+            raise RuntimeError('Forward model failed for member %i (%s)' % (member, self.errors[member]))
+        if len(self.failed) == num_ens:
+            raise RuntimeError('Forward model failed for all members')
+
+        N_obs = next(len(data) for _, data, _, _ in results if data is not None)
+        Obs_sim = np.full((N_obs, num_ens), np.nan)
+        for member, data, _, _ in results:
+            if data is not None:
+                Obs_sim[:, member] = data
+        return Obs_sim
+
+    def Summary(self):
+        return 'Forward model (%s): %i members, time mean %.3fs max %.3fs, %i failed' % (
+            self.backend, len(self.times), self.times.mean(), self.times.max(), len(self.failed))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
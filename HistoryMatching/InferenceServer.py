@@ -0,0 +1,110 @@
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, Future
+
+"""
+In-process inference server: several ModelDL (e.g. PCA, CVAE and GAN parameterizations)
+served by a thread pool. Requests to the same model are batched along the members
+axis and run in one predict call; different models run concurrently.
+"""
+
+class InferenceServer:
+    """
+    models: {name: ModelDL}.
+    max_batch: maximum number of members of a batched call (None: no limit).
+    """
+    def __init__(self, models, workers=None, max_batch=None):
+        self.models = dict(models)
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(max_workers=workers or len(self.models))
+        self.lock = threading.Lock()
+        self.pending = {name: [] for name in self.models}
+        self.running = {name: False for name in self.models}
+
+    def submit(self, name, data, is_update=True):
+        """Future with model.predict(data, is_update), data (features, members)"""
+        if name not in self.models:
+            raise KeyError('Unknown model %s' % name)
+        future = Future()
+        with self.lock:
+            self.pending[name].append((np.asarray(data), is_update, future))
+            # One drain task per model, it also serves the requests queued while running
+            if not self.running[name]:
+                self.running[name] = True
+                self.executor.submit(self._drain, name)
+        return future
+
+    def encode(self, name, data):
+        return self.submit(name, data, is_update=False)
+
+    def decode(self, name, data):
+        return self.submit(name, data, is_update=True)
+
+    def map(self, data, is_update=True, names=None):
+        """Runs data on every model concurrently, {name: result}"""
+        futures = {name: self.submit(name, data[name] if isinstance(data, dict) else data, is_update)
+                   for name in (names or self.models)}
+        return {name: future.result() for name, future in futures.items()}
+
+    def _next_batch(self, name):
+        # Requests of the same kind and number of features, up to max_batch members
+        with self.lock:
+            queue = self.pending[name]
+            if not queue:
+                self.running[name] = False
+                return []
+            data, is_update, _ = queue[0]
+            batch, size = [], 0
+            for request in list(queue):
+                if request[1] != is_update or request[0].shape[0] != data.shape[0]:
+                    continue
+                if batch and self.max_batch and size + request[0].shape[1] > self.max_batch:
+                    break
+                batch.append(request)
+                size += request[0].shape[1]
+            # By identity: the requests hold arrays, == would compare them
+            queue[:] = [request for request in queue if not any(request is taken for taken in batch)]
+            return batch
+
+    def _drain(self, name):
+        model = self.models[name]
+        batch = []
+        try:
+            batch = self._next_batch(name)
+            while batch:
+                futures = [future for _, _, future in batch if future.set_running_or_notify_cancel()]
+                try:
+                    data = np.concatenate([request[0] for request in batch], axis=1)
+                    result = model.predict(data, is_update=batch[0][1])
+                    start = 0
+                    for request in batch:
+                        members = request[0].shape[1]
+                        if any(request[2] is future for future in futures):
+                            request[2].set_result(result[:, start:start + members])
+                        start += members
+                except Exception as exc:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(exc)
+                batch = self._next_batch(name)
+        except BaseException as exc:
+            # The drain task must not die silently: pending requests get the error, the next submit restarts it
+            with self.lock:
+                queue, self.pending[name] = self.pending[name], []
+                self.running[name] = False
+            for _, _, future in batch + queue:
+                if not future.done() and (future.running() or future.set_running_or_notify_cancel()):
+                    future.set_exception(exc)
+            raise
+
+    def close(self, close_models=False):
+        self.executor.shutdown()
+        if close_models:
+            for model in self.models.values():
+                model.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
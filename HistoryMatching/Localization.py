@@ -0,0 +1,71 @@
+import numpy as np
+from scipy import sparse
+
+"""
+Distance based localization for ES-MDA. The tapering between the state cells
+and the observations is computed on the fly for the rows requested by the
+analysis step (Localization[rows]) or stored as a sparse matrix (ToSparse),
+so the dense N_m x N_obs matrix is never allocated.
+Only meaningful when the state is the facies grid (e.g. PCA with computeAll=True),
+not a latent vector.
+"""
+
+def GaspariCohn(z):
+    """Gaspari-Cohn fifth order taper for z = distance/radius (zero for z >= 2)"""
+    z = np.abs(np.asarray(z, dtype=float))
+    taper = np.zeros_like(z)
+    near = z <= 1
+    far = (z > 1) & (z < 2)
+    zn = z[near]
+    taper[near] = -zn**5/4 + zn**4/2 + 5*zn**3/8 - 5*zn**2/3 + 1
+    zf = z[far]
+    taper[far] = zf**5/12 - zf**4/2 + 5*zf**3/8 + 5*zf**2/3 - 5*zf + 4 - 2/(3*zf)
+    return taper
+
+
+def GridCoordinates(dim_shape):
+    """(row, column[, layer]) of every cell in the order used by GetFaciesIndex and ModelDL"""
+    cells = np.arange(int(np.prod(dim_shape)))
+    if len(dim_shape) > 2 and dim_shape[2] > 1:
+        # Layer after layer, as produced by the Fortran order reshapes of ModelDL
+        layer, cells = np.divmod(cells, dim_shape[0]*dim_shape[1])
+        return np.stack([cells // dim_shape[1], cells % dim_shape[1], layer], axis=1)
+    return np.stack([cells // dim_shape[1], cells % dim_shape[1]], axis=1)
+
+
+class Localization:
+    """
+    position: (N_wells, d) well coordinates, [row, column] as in GerenateObsFile.
+    radius: Gaspari-Cohn radius in cells (the taper vanishes at 2*radius).
+    dim_shape or coords: grid shape, or the (N_m, d') coordinates of each state variable.
+    Only the first d coordinates of the cells are used (vertical wells in 3D grids).
+    obs_well: well of each observation (default: the wells repeated for every time).
+    """
+    def __init__(self, position, radius, dim_shape=None, coords=None, obs_well=None, N_obs=None, dtype='float32'):
+        self.position = np.asarray(position, dtype=float)
+        self.radius = float(radius)
+        if coords is None:
+            coords = GridCoordinates(dim_shape)
+        self.coords = np.asarray(coords, dtype=float)[:, :self.position.shape[1]]
+        if obs_well is None:
+            N_wells = self.position.shape[0]
+            obs_well = np.tile(np.arange(N_wells), (N_obs or N_wells)//N_wells)
+        self.obs_well = np.asarray(obs_well)
+        self.dtype = dtype
+        self.shape = (self.coords.shape[0], len(self.obs_well))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        """Dense tapering of the state rows (slice or index array) against all observations"""
+        cells = self.coords[rows]
+        distance = np.sqrt(((cells[:, None, :] - self.position[None, :, :])**2).sum(axis=-1))
+        taper = GaspariCohn(distance/self.radius).astype(self.dtype)
+        return taper[:, self.obs_well]
+
+    def ToSparse(self, chunk_size=10000):
+        """CSR matrix (N_m, N_obs) with the non zero tapering"""
+        blocks = [sparse.csr_matrix(self[start:start + chunk_size])
+                  for start in range(0, self.shape[0], chunk_size)]
+        return sparse.vstack(blocks, format='csr')
@@ -1,9 +1,14 @@
 from Model.BiLinearUp import BilinearUpsampling
+from HistoryMatching.CallNetwork import GetModel, ClearModelCache
+from HistoryMatching.Quantize import QuantizedDecoder
 from keras_contrib.layers.normalization.instancenormalization import InstanceNormalization
 
 from keras.models import model_from_json
 from keras.utils import to_categorical
 import numpy as np
+import json
+import os
+from contextlib import contextmanager
 
 import tensorflow as tf
 from tensorflow.python.platform import gfile
@@ -21,15 +26,16 @@ class ModelDL_TF:
     def __init__(self, model, sess):
         self.model = model
         self.sess = sess
-        self.name_encoder_in = model['encoder_in']
+        self.name_encoder_in = model.get('encoder_in')
         self.name_decoder_in = model['decoder_in']
         self.decoder_tensor = self.load_tf(model['path_tf_red_decoder'], 'import/'+model['name_decoder'])
-        try:
-            self.encoder_tensor = self.load_tf(model['path_tf_red_encoder'], 'import_1/'+model['name_encoder'])
-            self.import_name='import_1/'
-        except:
-            self.encoder_tensor = self.load_tf(model['path_tf_red_encoder'], 'import/'+model['name_encoder'])
-            self.import_name='import/'
+        if model.get('path_tf_red_encoder'):
+            try:
+                self.encoder_tensor = self.load_tf(model['path_tf_red_encoder'], 'import_1/'+model['name_encoder'])
+                self.import_name='import_1/'
+            except:
+                self.encoder_tensor = self.load_tf(model['path_tf_red_encoder'], 'import/'+model['name_encoder'])
+                self.import_name='import/'
         self.x, self.y, self.z = self.model['Model_Dim']
 
     def load_tf(self,path, output_name):
@@ -37,8 +43,8 @@ class ModelDL_TF:
         graph_def = tf.GraphDef()
         graph_def.ParseFromString(f.read())
         f.close()
-        self.sess.graph.as_default()
-        gf = tf.import_graph_def(graph_def)
+        with self.sess.graph.as_default():
+            gf = tf.import_graph_def(graph_def)
         output_tensor = self.sess.graph.get_tensor_by_name(output_name)
         return output_tensor
 
@@ -64,7 +70,8 @@ class ModelDL_TF:
     def updateStateFacies(self, x_encoded):
 
         x_decoded = self.sess.run(self.decoder_tensor, {'import/'+self.name_decoder_in: x_encoded})
-        x_decoded = np.argmax(x_decoded, axis=-1)
+        # Single channel (binary facies, e.g. Gans decoders): sign of the output
+        x_decoded = (x_decoded[..., 0] > 0).astype(int) if x_decoded.shape[-1] == 1 else np.argmax(x_decoded, axis=-1)
         if self.z > 2:
             z_ = x_decoded.reshape((x_decoded.shape[0], self.x * self.y, self.z))
             data = z_.reshape((x_decoded.shape[0], self.x * self.y * self.z), order='F')
@@ -80,23 +87,76 @@ class ModelDL_TF:
         return x_out.T
 
 
+def LoadModelTF(path_manifest, sess=None):
+    # Loads the frozen graphs written by Model/freeze_model.py into a new graph and session
+    with open(path_manifest, 'r') as file:
+        model = json.load(file)
+    base = os.path.dirname(path_manifest)
+    for key in ['path_tf_red_decoder', 'path_tf_red_encoder']:
+        if key in model:
+            model[key] = os.path.join(base, model[key])
+    model['Model_Dim'] = tuple(model['Model_Dim'])
+    if sess is None:
+        sess = tf.Session(graph=tf.Graph())
+    return ModelDL_TF(model, sess)
+
+
 class ModelDL:
 
-    def __init__(self, model, bilinear=True):
+    def __init__(self, model, bilinear=True, precision='float32', representative=None, fused=False):
+        # precision: 'float32' (keras decoder), 'float16' or 'int8' (see Quantize.QuantizedDecoder)
+        # fused: argmax, uint8 cast and (cells, members) layout inside the decoder graph
         network = model['redePath']
 
         self.model = model
         self.bilinear = bilinear
 
+        self.names = []
+        self.encoder = None
         if not (self.model['PCA'] or self.model['IsGans']):
             self.encoder = self.load(network + '_encoder')
         self.decoder = self.load(network + '_decoder')
         self.x, self.y, self.z = self.model['Model_Dim']
-        sess = K.get_session()
-        self.graph = sess.graph
+        # Session holding the models, used by every encode/decode call until close()
+        self.sess = K.get_session()
+        self.graph = self.sess.graph
+        self.precision = precision
+        # float32 keras decoder, kept for quantizing again (QuantizationReport) or the fused graph
+        self.keras_decoder = self.decoder
+        if precision != 'float32':
+            with self.context():
+                self.decoder = QuantizedDecoder(self.decoder, precision, self.sess, representative)
+        self.fused = fused and precision == 'float32'
+        self.fused_decoder = None
         #self.graph = tf.Graph()        
 
+    @contextmanager
+    def context(self):
+        with self.graph.as_default(), self.sess.as_default():
+            yield
+
+    def close(self, evict=False):
+        # Drops the references to the models and the session. evict=True also removes the
+        # models from the process cache (the session is closed with the last cached model)
+        if evict:
+            for name in self.names:
+                ClearModelCache(name)
+        self.names = []
+        self.encoder = self.decoder = self.keras_decoder = self.fused_decoder = None
+        self.sess = self.graph = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def load(self, model_name):
+        # Loaded once per process (see CallNetwork.GetModel)
+        self.names.append(model_name)
+        return GetModel(model_name, self.load_model, ('ModelDL', self.bilinear, self.model['IsGans']))
+
+    def load_model(self, model_name):
         model_path = model_name + '.json'
         weights_path = model_name + '_weights.hdf5'
 
@@ -112,7 +172,7 @@ class ModelDL:
         try:
             loaded_model.load_weights(weights_path)        
         except:
-            if is_gans:
+            if self.model['IsGans']:
                 loaded_model.build((None, self.model['N']))
                 loaded_model.load_weights(weights_path)   
         
@@ -121,13 +181,12 @@ class ModelDL:
     def createStateFacies(self, data):
         if self.model['PCA']:
             x_test_mean = data - self.model['mu']
-            x_encoded = (1/self.model['Z']) * np.dot(self.model['Us_inv'], x_test_mean.T)          
+            x_encoded = (1/self.model['Z']) * self.model['Us_inv'].dot(x_test_mean.T)          
             return x_encoded.T
 
         if self.model['IsGans']:
             return data
 
-        sess = tf.Session(graph=self.graph)
         if self.z > 2:
             data = data.reshape((data.shape[0], ) + (self.x * self.y, self.z), order='F')
 
@@ -139,24 +198,59 @@ class ModelDL:
         if self.model['isTanh']:
             data = 2 * data - 1
 
-        x_encoded = self.encoder.predict(data)
+        with self.context():
+            x_encoded = self.encoder.predict(data)
 
         return x_encoded
 
-    def updateStateFacies(self, x_encoded):
+    def decoderInput(self, x_encoded):
         if self.model['PCA']:
             x_encoded = x_encoded.T
-            data = self.model['mu'] + (self.model['Z']) * np.dot(self.model['Us'], x_encoded).T 
+            data = self.model['mu'] + (self.model['Z']) * self.model['Us'].dot(x_encoded).T 
             if self.z > 2:
                 data = data.reshape((data.shape[0], ) + (self.x * self.y, self.z), order='F')            
             x_encoded = data.reshape((data.shape[0], ) + (self.x, self.y, self.z))
+        return x_encoded
+
+    def buildFusedDecoder(self):
+        # Facies codes computed in the graph: (N, x, y[, z], NumFacies) -> uint8 (cells, N),
+        # cells ordered as in updateStateFacies (layer after layer for z > 2)
+        with self.context():
+            x_decoded = self.decoder.outputs[0]
+            if self.model['toCategorical']:
+                facies = K.cast(K.argmax(x_decoded, axis=-1), 'uint8')
+            else:
+                facies = K.cast(K.greater(x_decoded, 0), 'uint8')
+                if K.int_shape(x_decoded)[-1] == 1:
+                    facies = facies[..., 0]
+            if self.z > 2:
+                facies = K.permute_dimensions(facies, (3, 1, 2, 0))
+            else:
+                facies = K.permute_dimensions(facies, tuple(range(1, K.ndim(facies))) + (0, ))
+            facies = K.reshape(facies, (self.x * self.y * self.z, -1))
+            return K.function([self.decoder.inputs[0]], [facies])
+
+    def decodeFacies(self, x_encoded):
+        # x_encoded (N, features) -> uint8 facies (cells, N) with the fused decoder,
+        # rebuilt when self.decoder is replaced by another keras model
+        if self.fused_decoder is None or self.fused_decoder[0] is not self.decoder:
+            self.fused_decoder = (self.decoder, self.buildFusedDecoder())
+        x_encoded = self.decoderInput(x_encoded)
+        with self.context():
+            try :
+                return self.fused_decoder[1]([x_encoded])[0]
+            except :
+                return self.fused_decoder[1]([np.expand_dims(x_encoded,axis=-1)])[0]
+
+    def updateStateFacies(self, x_encoded):
+        x_encoded = self.decoderInput(x_encoded)
                         
-        sess = tf.Session(graph=self.graph)
-        try :
-            x_decoded = self.decoder.predict(x_encoded)
-        except :
-            x_encoded = np.expand_dims(x_encoded,axis=-1)
-            x_decoded = self.decoder.predict(x_encoded)
+        with self.context():
+            try :
+                x_decoded = self.decoder.predict(x_encoded)
+            except :
+                x_encoded = np.expand_dims(x_encoded,axis=-1)
+                x_decoded = self.decoder.predict(x_encoded)
 
         if self.model['toCategorical']:
             x_decoded = np.argmax(x_decoded, axis=-1)
@@ -172,9 +266,30 @@ class ModelDL:
 
         return data
 
-    def predict(self, data, is_update=True):
-
-        x_test = data.T.astype('float32')
-        x_out = (self.updateStateFacies(x_test) if is_update else self.createStateFacies(x_test))
-
-        return x_out.T 
+    def transform(self, x_test, is_update=True):
+        # x_test (members, features) -> (features, members)
+        if not is_update:
+            return self.createStateFacies(x_test).T
+        # The fused graph is built from the keras float32 decoder only
+        if self.fused and not isinstance(self.decoder, QuantizedDecoder):
+            return self.decodeFacies(x_test)
+        return self.updateStateFacies(x_test).T
+
+    def predict(self, data, is_update=True, chunk_size=None, out=None):
+        # data: (features, members). With chunk_size or out the members are processed by
+        # chunks and written in out, preallocated as uint8 facies (decode) or float32 (encode)
+        if chunk_size is None and out is None:
+            x_test = data.T.astype('float32')
+            return self.transform(x_test, is_update)
+
+        for start, x_out in self.predict_chunks(data, is_update, chunk_size or data.shape[1]):
+            if out is None:
+                out = np.empty((x_out.shape[0], data.shape[1]), dtype=np.uint8 if is_update else np.float32)
+            out[:, start:start + x_out.shape[1]] = x_out
+        return out
+
+    def predict_chunks(self, data, is_update=True, chunk_size=1000):
+        # Generator of (first member, result (features, members)) for chunk_size members at a time
+        for start in range(0, data.shape[1], chunk_size):
+            x_test = data[:, start:start + chunk_size].T.astype('float32')
+            yield start, self.transform(x_test, is_update) 
@@ -0,0 +1,99 @@
+import time
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+"""
+Reduced precision decoders for ModelDL (post-training quantization with TF Lite).
+'float16' stores the weights in half precision, 'int8' quantizes weights and
+activations calibrated on a representative set of decoder inputs.
+BilinearUpsampling (tf.image.resize_bilinear) maps to the builtin RESIZE_BILINEAR op.
+"""
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+
+def Representative(input_shape, num_samples=100, seed=0):
+    # Decoder inputs for the int8 calibration: draws of the N(0, 1) latent prior
+    rng = np.random.RandomState(seed)
+    shape = tuple(1 if i is None else i for i in input_shape)
+    return [rng.randn(*shape).astype('float32') for _ in range(num_samples)]
+
+
+class QuantizedDecoder:
+    """
+    Same predict interface as the keras decoder.
+    decoder: keras model loaded in sess (default: the keras session).
+    representative: list of decoder inputs (batch of one) for the int8 calibration,
+    by default draws of the latent prior (give real inputs for PCA or Gans decoders).
+    """
+    def __init__(self, decoder, precision='float16', sess=None, representative=None):
+        if precision not in PRECISIONS:
+            raise ValueError('precision must be one of ' + ', '.join(PRECISIONS))
+        self.precision = precision
+        self.input_shape = decoder.input_shape
+        sess = sess or K.get_session()
+
+        converter = tf.lite.TFLiteConverter.from_session(sess, decoder.inputs, decoder.outputs)
+        if precision == 'float16':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        elif precision == 'int8':
+            if representative is None:
+                representative = Representative(self.input_shape)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = lambda: ([x] for x in representative)
+        self.tflite_model = converter.convert()
+
+        self.interpreter = tf.lite.Interpreter(model_content=self.tflite_model)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def predict(self, x):
+        x = np.asarray(x, dtype='float32')
+        if len(x.shape) != len(self.input_shape):
+            raise ValueError('Input of rank %i, expected %i' % (len(x.shape), len(self.input_shape)))
+        # The interpreter is resized only when the number of members changes
+        if x.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, list(x.shape))
+            self.interpreter.allocate_tensors()
+            self.batch_size = x.shape[0]
+        self.interpreter.set_tensor(self.input_index, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            file.write(self.tflite_model)
+
+
+def ArgmaxAgreement(reference, facies):
+    """Fraction of cells with the same facies (outputs of ModelDL.predict)"""
+    return float(np.mean(np.asarray(reference) == np.asarray(facies)))
+
+
+def QuantizationReport(model, latent, precisions=PRECISIONS, representative=None, chunk_size=None):
+    """
+    Decodes latent (N_latent, N_ens) with model (ModelDL) in each precision and
+    returns {precision: (time in s, facies agreement with float32)}.
+    The reference and the quantized decoders come from model.keras_decoder (also when model
+    was built in reduced precision); the decoder of model is restored at the end. Every precision
+    runs through decoder.predict (a fused model is timed and compared without the fused graph).
+    """
+    decoder, fused = model.decoder, model.fused
+    keras_decoder = model.keras_decoder
+    model.fused = False
+    report = {}
+    try:
+        model.decoder = keras_decoder
+        reference = model.predict(latent, chunk_size=chunk_size)
+        for precision in precisions:
+            with model.context():
+                model.decoder = keras_decoder if precision == 'float32' else QuantizedDecoder(keras_decoder, precision, model.sess, representative)
+            start = time.perf_counter()
+            facies = model.predict(latent, chunk_size=chunk_size)
+            report[precision] = (time.perf_counter() - start, ArgmaxAgreement(reference, facies))
+    finally:
+        model.decoder, model.fused = decoder, fused
+    return report
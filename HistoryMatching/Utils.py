@@ -4,8 +4,9 @@ import numpy as np
 import h5py
 import scipy.io as sio
 import sys
+import os
 from HistoryMatching.CallNetwork import CVAE_function
-from HistoryMatching.ES_MDA import ES_MDA
+from HistoryMatching.ES_MDA import ES_MDA, ESMDA_NP
 import matplotlib.pyplot as plt
 
 
@@ -87,10 +88,18 @@ def UpdateStateFacies(data,dimention_x,dimention_y,redeVAE='CVAE45(sig)'):
     M_Face = CVAE_function(data,dimention_x,dimention_y,'Decoder',redeVAE)
     return M_Face
 
+def GetFaciesIndex(dimention,position):
+    # Flat index of each well (row position[:,0], column position[:,1]) in a facies vector
+    position = np.asarray(position)
+    return position[:,0]*dimention[1] + position[:,1]
+
+def GetFaciesEnsembleData(m_f,index):
+    # Facies at the wells for the whole ensemble (N_cells, N_ens) -> (N_wells, N_ens)
+    return m_f[index]
+
 def GetFaciesData(facies,dimention,position,path_save):
-    layers = facies.reshape([int(len(facies)/dimention[1]),dimention[1]])
     std = 0.1    
-    values = [layers[position[i,0],position[i,1]] for i  in range(position.shape[0])]
+    values = list(np.ravel(facies)[GetFaciesIndex(dimention,position)])
     if (path_save==''):
         return values
     file = open(path_save,'w') 
@@ -100,17 +109,105 @@ def GetFaciesData(facies,dimention,position,path_save):
     file.close()
     return values
 
-def Contitional_ES_MDA(alp,Corr,position,obs,R,m_x,m_f,dim_shape,redeVAE):
+def SaveCheckpoint(path,step,m_x,m_f,rng,alphas=()):
+    # Number of completed steps, ensembles, RNG state and alphas used; written atomically
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    tmp = path + '.tmp'
+    with open(tmp,'wb') as file:
+        np.savez(file, step=step, m_x=m_x, m_f=m_f, rng_keys=keys, rng_pos=pos,
+                 rng_has_gauss=has_gauss, rng_cached_gaussian=cached_gaussian,
+                 alphas=np.asarray(alphas, dtype=float))
+    os.replace(tmp, path)
+
+def LoadCheckpoint(path,rng=None):
+    with np.load(path) as data:
+        if rng is not None:
+            rng.set_state(('MT19937', data['rng_keys'], int(data['rng_pos']),
+                           int(data['rng_has_gauss']), float(data['rng_cached_gaussian'])))
+        return int(data['step']), data['m_x'], data['m_f'], list(data['alphas'])
+
+def AdaptiveAlpha(esmda,Obs_sim,obs,alphas,alp,rho=0.2):
+    # alpha from the regularizing Levenberg-Marquardt rule, kept within the budget
+    # sum(1/alpha) = 1; the last allowed step uses the remaining budget
+    remaining = 1 - sum(1/a for a in alphas)
+    if len(alphas) == alp-1:
+        return 1/remaining
+    return max(esmda.InflationLM(Obs_sim, obs, rho), 1/remaining)
+
+def Contitional_ES_MDA(alp,Corr,position,obs,R,m_x,m_f,dim_shape,redeVAE,forward=None,checkpoint=None,resume=False,
+                       schedule='fixed',tol=1.5,rho=0.2,chunk_size=None):
+    # forward: optional ForwardModel run on m_f instead of reading the facies at the wells
+    # checkpoint: NPZ file saved after each alpha step; resume continues from it when it exists
+    # schedule: 'fixed' (alp steps with alpha=alp) or 'adaptive': at most alp steps, each one
+    # reducing the data residual by about rho, stopping when the mean normalized misfit
+    # reaches tol (discrepancy principle, a misfit of 1 is the noise level)
+    # chunk_size: state rows updated at once (see ESMDA_NP)
     Alpha = np.ones((alp),dtype=int)*alp
-    for t in range(len(Alpha)):
-        Obs_sim = [((GetFaciesData(m_f[:,i],dim_shape,position,''))) for i in range(m_f.shape[1])]
-        Obs_sim=  np.array(Obs_sim).T
-        print('Erro ite_',t, ' : ' ,sum(sum(abs(Obs_sim-obs))))    
-        m_x = ES_MDA(m_f.shape[1],m_x,obs,Obs_sim,Alpha[t],R,Corr,2)
+    esmda = ESMDA_NP(R, 2, chunk_size=chunk_size)
+    index = GetFaciesIndex(dim_shape,position)
+    start = 0
+    alphas = []
+    if resume and checkpoint is not None and os.path.exists(checkpoint):
+        start, m_x, m_f, alphas = LoadCheckpoint(checkpoint, esmda.rng)
+        print('Resuming from step', start)
+
+    def simulate(m_f):
+        if forward is None:
+            return GetFaciesEnsembleData(m_f,index), np.arange(m_f.shape[1])
+        Obs_sim = forward.run(m_f)
+        print(forward.Summary())
+        return Obs_sim, np.setdiff1d(np.arange(m_f.shape[1]), forward.failed)
+
+    Obs_sim = None
+    for t in range(start, len(Alpha)):
+        Obs_sim, ok = simulate(m_f)
+        print('Erro ite_',t, ' : ' ,np.abs(Obs_sim[:,ok]-obs).sum())    
+        if schedule == 'adaptive':
+            misfit = esmda.Misfit(Obs_sim[:,ok], obs).mean()
+            if misfit <= tol or 1 - sum(1/a for a in alphas) < 1e-8:
+                print('Stop at step', t, 'normalized misfit :', misfit)
+                break
+            alpha = AdaptiveAlpha(esmda, Obs_sim[:,ok], obs, alphas, alp, rho)
+        else:
+            alpha = Alpha[t]
+        alphas.append(alpha)
+        if len(ok) == m_f.shape[1]:
+            m_x = esmda.Analysis(m_x,obs,Obs_sim,alpha,Corr)
+        else:
+            # Failed members keep their state and are simulated again in the next step
+            m_x = m_x.copy()
+            m_x[:,ok] = esmda.Analysis(m_x[:,ok],obs,Obs_sim[:,ok],alpha,Corr)
         #m_f = UpdateStateFacies(m_x,dim_shape[0],dim_shape[1],redeVAE)
         m_f = redeVAE.predict(m_x)
-    Obs_sim = [((GetFaciesData(m_f[:,i],dim_shape,position,''))) for i in range(m_f.shape[1])]
-    Obs_sim=  np.array(Obs_sim).T
-    print('Erro End: ',sum(sum(abs(Obs_sim-obs))))
+        Obs_sim = None
+        if checkpoint is not None:
+            SaveCheckpoint(checkpoint, t+1, m_x, m_f, esmda.rng, alphas)
+    if Obs_sim is None:
+        Obs_sim, ok = simulate(m_f)
+    print('Erro End: ',np.abs(Obs_sim[:,ok]-obs).sum())
     return m_f
 
+def Contitional_ES_MDA_Batch(alp,Corr,positions,obs_list,R_list,m_x,m_f,dim_shape,redeVAE,chunk_size=None):
+    # Assimilates several observation sets (scenarios) against the same prior m_x/m_f.
+    # The posteriors of all scenarios are decoded together in one call to redeVAE.predict
+    # per step. Corr is shared or given per scenario. Returns one m_f per scenario.
+    num_scenarios = len(obs_list)
+    num_ens = m_x.shape[1]
+    Alpha = np.ones((alp),dtype=int)*alp
+    if not isinstance(Corr, (list, tuple)) or len(Corr) == 0:
+        Corr = [Corr]*num_scenarios
+    engines = [ESMDA_NP(R, 2, chunk_size=chunk_size) for R in R_list]
+    indexes = [GetFaciesIndex(dim_shape,position) for position in positions]
+    m_x_list = [m_x]*num_scenarios
+    m_f_list = [m_f]*num_scenarios
+    for t in range(len(Alpha)):
+        for s in range(num_scenarios):
+            Obs_sim = GetFaciesEnsembleData(m_f_list[s],indexes[s])
+            print('Scenario',s,'Erro ite_',t, ' : ' ,np.abs(Obs_sim-obs_list[s]).sum())
+            m_x_list[s] = engines[s].Analysis(m_x_list[s],obs_list[s],Obs_sim,Alpha[t],Corr[s])
+        m_f_all = redeVAE.predict(np.hstack(m_x_list))
+        m_f_list = [m_f_all[:, s*num_ens:(s+1)*num_ens] for s in range(num_scenarios)]
+    for s in range(num_scenarios):
+        Obs_sim = GetFaciesEnsembleData(m_f_list[s],indexes[s])
+        print('Scenario',s,'Erro End: ',np.abs(Obs_sim-obs_list[s]).sum())
+    return m_f_list
@@ -130,7 +130,7 @@ class Utilities(object):
         n_rows, n_cols = dims[0], dims[1]
         Us, Us_inv, const, nc, mu = pca_model[0], pca_model[1], pca_model[2], pca_model[3], pca_model[4] 
         z_sample = np.random.normal(0, 1.0, [nc, Nt])
-        model_pca = const * np.dot(Us, z_sample) + mu.reshape(n_rows*n_cols, 1)
+        model_pca = const * Us.dot(z_sample) + mu.reshape(n_rows*n_cols, 1)
         model_pca = model_pca.T
         model_pca = model_pca.reshape(-1, n_rows, n_cols, 1)
         if plots:
@@ -145,9 +145,9 @@ class Utilities(object):
         # centering data
         data_C = data - mu
         # Encoding
-        z_codes = (1.0 / const) * np.dot(Us_inv, data_C.T)
+        z_codes = (1.0 / const) * Us_inv.dot(data_C.T)
         # Decoding
-        data_decoded = (const) * np.dot(Us, z_codes).T + mu
+        data_decoded = (const) * Us.dot(z_codes).T + mu
         data_decoded = data_decoded.reshape(-1, n_rows, n_cols, 1)
         if plots:
             PlotDataAE(data, data_decoded, digit_size=(n_rows, n_cols), Only_Result=True, num=5)
@@ -158,3 +158,94 @@ class Utilities(object):
         for i in range(len(data)):
             data[i] = 2 * (data[i] - data[i].min()) / (data[i].max() - data[i].min()) - 1.0
         return data
+
+
+class GanData(object):
+    """
+    Training and validation batches for the GAN trainers without copies of the dataset.
+    data_trn / data_val: array or memory map (shuffled through index permutations), or a
+    batch source: MPS_Generator / MPS_Memmap (mps_generator) or any iterator of batches,
+    with steps batches per epoch (default len(source)). Integer (one-hot uint8) batches are
+    converted per batch to float32, in [-1, 1] if isTanh; float batches are used as they are.
+    Without data_val the validation is split from data_trn (split fraction) for arrays;
+    sources need data_val (a repeated stream cannot hold samples out of the training).
+    """
+    def __init__(self, data_trn, data_val=None, batch_size=32, split=0.9, isTanh=True, steps=None):
+        self.batch_size = batch_size
+        self.isTanh = isTanh
+        self.steps = steps
+        self.trn = data_trn
+        self.val = data_val
+        self.trn_index = self.val_index = None
+        self.streams = {}
+        if isinstance(data_trn, np.ndarray):
+            index = np.arange(len(data_trn))
+            if data_val is None:
+                np.random.shuffle(index)
+                self.val = data_trn
+                self.val_index = np.sort(index[int(split*len(index)):])
+                index = np.sort(index[:int(split*len(index))])
+            self.trn_index = index
+        elif data_val is None:
+            raise ValueError('data_val is required when data_trn is a batch source')
+        if isinstance(self.val, np.ndarray) and self.val_index is None:
+            self.val_index = np.arange(len(self.val))
+
+    def convert(self, x):
+        x = np.asarray(x)
+        if np.issubdtype(x.dtype, np.integer):
+            x = x.astype(np.float32)
+            if self.isTanh:
+                x = 2 * x - 1
+        return x
+
+    def next_batch(self, validation=False):
+        # Next batch of a source, one persistent iterator for the training and one for the validation
+        if validation not in self.streams:
+            source = self.val if validation else self.trn
+            self.streams[validation] = source.mps_generator() if hasattr(source, 'mps_generator') else iter(source)
+        x = next(self.streams[validation])
+        return x[0] if isinstance(x, tuple) else x
+
+    def source_len(self, source):
+        return self.steps or (len(source) if hasattr(source, '__len__') else 100)
+
+    @property
+    def num_batches(self):
+        if self.trn_index is not None:
+            return len(self.trn_index) // self.batch_size
+        return self.source_len(self.trn)
+
+    def batches(self, validation=False):
+        """One epoch of converted batches (new order every call)"""
+        data, index = (self.val, self.val_index) if validation else (self.trn, self.trn_index)
+        if index is None:
+            for _ in range(self.source_len(data)):
+                yield self.convert(self.next_batch(validation))
+            return
+        index = np.random.permutation(index)
+        for i in range(len(index) // self.batch_size):
+            yield self.convert(data[np.sort(index[i * self.batch_size:(i + 1) * self.batch_size])])
+
+    def random_batch(self, n=None):
+        """Random training batch (without replacement)"""
+        if self.trn_index is None:
+            return self.convert(self.next_batch()[:n or self.batch_size])
+        return self.convert(self.trn[np.sort(np.random.choice(self.trn_index, n or self.batch_size, replace=False))])
+
+    def val_sample(self, n=None):
+        """Random validation batch"""
+        if self.val_index is None:
+            return self.convert(self.next_batch(validation=True)[:n or self.batch_size])
+        return self.convert(self.val[np.sort(np.random.choice(self.val_index, n or self.batch_size, replace=False))])
+
+    def trn_sample(self, n):
+        """First n training samples (plots)"""
+        if self.trn_index is None:
+            return self.convert(self.next_batch()[:n])
+        return self.convert(self.trn[self.trn_index[:n]])
+
+
+def AsGanData(data_trn, data_val=None, batch_size=32, split=0.9, steps=None):
+    # Shared by train() so that fit_gans and fit_encoder use the same split
+    return data_trn if isinstance(data_trn, GanData) else GanData(data_trn, data_val, batch_size, split, steps=steps)
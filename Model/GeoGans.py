@@ -20,7 +20,7 @@ from keras.models import model_from_json
 from keras.utils import to_categorical
 from Model.BiLinearUp import BilinearUpsampling
 from Model.Utils import Save_Model, PlotDataAE
-from Model.GansUtilities import Utilities
+from Model.GansUtilities import Utilities, AsGanData
 from Model.GansNetworks import Networks
 
 import random
@@ -168,11 +168,13 @@ class GAN2D_MPS(object):
               num_plots=4,
               plot_freq=2,
               soft_labels=0.2,
-              reset_model=True):
-        
-        self.fit_gans(data_trn, data_val, epochs, best_acc, n_iterations, g_steps, patience, split,
+              reset_model=True,
+              steps=None):
+        # data_trn: array or batch source (MPS_Generator, MPS_Memmap, iterator of batches), see GanData
+        data = AsGanData(data_trn, data_val, self.batch_size, split, steps)
+        self.fit_gans(data, None, epochs, best_acc, n_iterations, g_steps, patience, split,
                       plots=plots, num_plots=num_plots, plot_freq=plot_freq, soft_labels=soft_labels, reset_model=reset_model)
-        self.fit_encoder(data_trn, data_val, epochs, best_acc, patience, split,
+        self.fit_encoder(data, None, epochs, best_acc, patience, split,
                          plots=plots, num_plots=num_plots, plot_freq=plot_freq, reset_model=reset_model)
 
         
@@ -189,7 +191,8 @@ class GAN2D_MPS(object):
                  num_plots=4,
                  plot_freq=2,
                  soft_labels=0.2,
-                 reset_model=True):
+                 reset_model=True,
+                 steps=None):
         #TODO: add exeptions
         """
         optimize the discriminator and generators models using adversarial training
@@ -206,30 +209,21 @@ class GAN2D_MPS(object):
             self.sess.run(init_gvars)
             print ("Initializing gans models variables ...")      
         
-        # set training and validation samples
-        if data_val_ is None:
-            data_trn = data_trn_.copy()
-            np.random.shuffle(data_trn)
-            data_val = data_trn[int(split*len(data_trn)):]
-            data_trn = data_trn[:int(split*len(data_trn))]
-        else:
-            data_trn = data_trn_.copy()
-            data_val = data_val_.copy()
+        # set training and validation samples (index permutations or batch source, see GanData)
+        data = AsGanData(data_trn_, data_val_, self.batch_size, split, steps)
         
         print("Starting GANs training ...")
         labels_real = np.reshape(np.ones((self.batch_size,)), (-1, 1))
         labels_fake = np.reshape(np.zeros((self.batch_size,)), (-1, 1))
-        number_of_batches = data_trn.shape[0] // self.batch_size
+        number_of_batches = data.num_batches
         patience_trn = patience
         for epoch in range(epochs):
-            np.random.shuffle(data_trn)            
             loss_D, loss_G = [], []
-            for index in range(0, number_of_batches):
+            for index, volumes_batch in enumerate(data.batches()):
                 labels_real_noised = labels_real - np.random.uniform(0, soft_labels, (self.batch_size, 1))
                 labels_fake_noised = labels_fake + np.random.uniform(0, soft_labels, (self.batch_size, 1))
 
                 z_samples = np.random.normal(0, 1, size=[self.batch_size, self.z_size]).astype(np.float32)
-                volumes_batch = data_trn[index * self.batch_size:(index + 1) * self.batch_size, :, :, :]
 
                 # Update D network
                 self.sess.run([d_optim, self.d_loss],
@@ -265,10 +259,10 @@ class GAN2D_MPS(object):
                 PlotDataAE([], fake_volumes, digit_size=(self.n_rows, self.n_cols), cmap='jet', Only_Result=False, num=num_plots)
 
             self.sess.run(init_zvars)
-            np.random.shuffle(data_val)
+            val_batch = data.val_sample()
             for _ in range(n_iterations):
                 _, d_loss_, g_loss_, acc_ = self.sess.run([z_optim, self.dz_loss, self.gz_loss, self.accuracy_z],
-                                                          feed_dict={self.real_img: data_val[:self.batch_size]})
+                                                          feed_dict={self.real_img: val_batch})
             print('\n')
             print('D loss ->', d_loss_, 'G loss ->', g_loss_, 'reconstruction acc ->', acc_.mean())
 
@@ -298,7 +292,8 @@ class GAN2D_MPS(object):
                     plots=True,
                     num_plots=4,
                     plot_freq=2,
-                    reset_model=True
+                    reset_model=True,
+                    steps=None
                     ):
         #TODO: Delete models after training
         # Learning parameters must be defined here
@@ -313,30 +308,18 @@ class GAN2D_MPS(object):
             self.sess.run(init_op)
             print ("Initializing encoder variables ...")
 
-        # Setting training and validation samples
-        if data_val_ is None:
-            data_trn = data_trn_.copy()
-            np.random.shuffle(data_trn)
-            data_val = data_trn[int(split*len(data_trn)):]
-            data_trn = data_trn[:int(split*len(data_trn))]
-        else:
-            data_trn = data_trn_.copy()
-            data_val = data_val_.copy()
+        # Setting training and validation samples (index permutations or batch source, see GanData)
+        data = AsGanData(data_trn_, data_val_, self.batch_size, split, steps)
 
         print("Starting Encoder training ...")
         patience_trn = patience
         for epoch in range(10*epochs):
-            np.random.shuffle(data_trn)
-            number_of_batches = data_trn.shape[0] // self.batch_size
-            for index in range(0, number_of_batches):
-                volumes_batch = data_trn[index * self.batch_size:(index + 1) * self.batch_size]
+            for volumes_batch in data.batches():
                 self.sess.run([e_optim], 
                               feed_dict={self.real_img: volumes_batch})
             # Validation
-            number_of_batches = data_val.shape[0] // self.batch_size
             loss_E, loss_D, Acc = [], [], []
-            for index in range(0, number_of_batches):
-                volumes_batch = data_val[index * self.batch_size:(index + 1) * self.batch_size]
+            for index, volumes_batch in enumerate(data.batches(validation=True)):
                 errE, errD, acc_e, deco_imgs = self.sess.run([self.e_loss, self.d_loss_enc, self.accuracy_e, self.deco_img],
                                                              feed_dict={self.real_img: volumes_batch})
             
@@ -357,7 +340,7 @@ class GAN2D_MPS(object):
                 break
 
             if plots and epoch % plot_freq:
-                real_samples = data_trn[:num_plots]
+                real_samples = data.trn_sample(num_plots)
                 deco_samples = self.decoder.predict(self.encoder.predict(real_samples))
                 real_samples = np.argmax(real_samples, axis=-1)
                 deco_samples = np.argmax(deco_samples, axis=-1)
@@ -526,11 +509,13 @@ class WGAN2D_MPS(object):
               plots=True,
               num_plots=4,
               plot_freq=2,
-              reset_model=True):
-        
-        self.fit_gans(data_trn, data_val, epochs, best_acc, n_iterations, patience, split,
+              reset_model=True,
+              steps=None):
+        # data_trn: array or batch source (MPS_Generator, MPS_Memmap, iterator of batches), see GanData
+        data = AsGanData(data_trn, data_val, self.batch_size, split, steps)
+        self.fit_gans(data, None, epochs, best_acc, n_iterations, patience, split,
                       plots=plots, num_plots=num_plots, plot_freq=plot_freq, reset_model=reset_model)
-        self.fit_encoder(data_trn, data_val, epochs, best_acc, patience, split,
+        self.fit_encoder(data, None, epochs, best_acc, patience, split,
                          plots=plots, num_plots=num_plots, plot_freq=plot_freq, reset_model=reset_model)
         
     def fit_gans(self,
@@ -545,7 +530,8 @@ class WGAN2D_MPS(object):
                  num_plots=4,
                  plot_freq=2,
                  th_acc = 90,
-                 reset_model=True):
+                 reset_model=True,
+                 steps=None):
         """
         optimize the discriminator and generators models using adversarial training
         """
@@ -563,15 +549,8 @@ class WGAN2D_MPS(object):
             self.sess.run(init_gvars)
             print ("Initializing GANs models variables ...")      
         
-        # Setting training and validation samples
-        if data_val_ is None:
-            data_trn = data_trn_.copy()
-            np.random.shuffle(data_trn)
-            data_val = data_trn[int(split*len(data_trn)):]
-            data_trn = data_trn[:int(split*len(data_trn))]
-        else:
-            data_trn = data_trn_.copy()
-            data_val = data_val_.copy()            
+        # Setting training and validation samples (index permutations or batch source, see GanData)
+        data = AsGanData(data_trn_, data_val_, self.batch_size, split, steps)
         
         print("Starting GANs training ...")
         g_step = 0
@@ -588,8 +567,7 @@ class WGAN2D_MPS(object):
             for _ in range(n_critic):
                 z_samples = np.random.normal(0, 1, size=[self.batch_size, self.z_size]).astype(np.float32)
                 # Select a random batch of images
-                idx = np.random.choice(data_trn.shape[0], self.batch_size, replace=False)
-                imgs = data_trn[idx]
+                imgs = data.random_batch()
                 # Update D network
                 _, d_loss = self.sess.run([d_optim, self.d_loss],
                                           feed_dict={self.real_img: imgs,
@@ -619,13 +597,11 @@ class WGAN2D_MPS(object):
             # Reconstruction accuracy
             if (iteration+1) % (iterations) == 0:
                 # Select a random batch of images
-                idx = np.random.randint(0, data_val.shape[0], self.batch_size)
-                imgs = data_val[idx]
+                val_batch = data.val_sample()
                 self.sess.run(init_zvars)
-                np.random.shuffle(data_val)
                 for _ in range(n_iterations):                
                     _, g_loss_, acc_ = self.sess.run([z_optim, self.gz_loss, self.accuracy_z],
-                                                        feed_dict={self.real_img: data_val[:self.batch_size]})
+                                                        feed_dict={self.real_img: val_batch})
                 
                 # print('Iteration: ', iteration+1, '  G loss: ', g_loss_, '  Accuracy: ', acc_.mean())
                 self.history['acc'].append(acc_)
@@ -655,8 +631,8 @@ class WGAN2D_MPS(object):
         self.build_model(model_file=self.saving_path+self.name_base, model_file_enc=None, summary=False)
 
     def fit_encoder(self,
-                    data_trn,
-                    data_val=None,
+                    data_trn_,
+                    data_val_=None,
                     epochs=1,
                     best_acc=-np.inf,
                     patience=50,
@@ -664,7 +640,8 @@ class WGAN2D_MPS(object):
                     plots=True,
                     num_plots=4,
                     plot_freq=2,
-                    reset_model=True
+                    reset_model=True,
+                    steps=None
                     ):
 
         e_optim = tf.compat.v1.train.AdamOptimizer(self.e_lr, beta1=self.beta1).minimize(self.e_loss, var_list=self.e_vars)
@@ -678,26 +655,18 @@ class WGAN2D_MPS(object):
             self.sess.run(init_op)
             print ("Initializing encoder variables ...")
 
-        # Setting training and validation samples
-        if data_val is None:
-            np.random.shuffle(data_trn)
-            data_val = data_trn[int(split*len(data_trn)):]
-            data_trn = data_trn[:int(split*len(data_trn))]
+        # Setting training and validation samples (index permutations or batch source, see GanData)
+        data = AsGanData(data_trn_, data_val_, self.batch_size, split, steps)
 
         print("Starting Encoder training ...")
         patience_trn = patience
         for epoch in range(10*epochs):
-            np.random.shuffle(data_trn)
-            number_of_batches = data_trn.shape[0] // self.batch_size
-            for index in range(0, number_of_batches):
-                volumes_batch = data_trn[index * self.batch_size:(index + 1) * self.batch_size]
+            for volumes_batch in data.batches():
                 self.sess.run([e_optim], 
                               feed_dict={self.real_img: volumes_batch})
             # Validation
-            number_of_batches = data_val.shape[0] // self.batch_size
             loss_E, loss_D, Acc = [], [], []
-            for index in range(0, number_of_batches):
-                volumes_batch = data_val[index * self.batch_size:(index + 1) * self.batch_size]
+            for index, volumes_batch in enumerate(data.batches(validation=True)):
                 errE, acc_e, deco_imgs = self.sess.run([self.e_loss, self.accuracy_e, self.deco_img],
                                                              feed_dict={self.real_img: volumes_batch})
                 loss_E.append(errE)
@@ -710,7 +679,7 @@ class WGAN2D_MPS(object):
                 if self.saving_path:
                     Save_Model(self.encoder, self.saving_path + self.encoder_name)
                 if plots and index % plot_freq:
-                    real_samples = data_trn[:num_plots]
+                    real_samples = data.trn_sample(num_plots)
                     deco_samples = self.decoder.predict(self.encoder.predict(real_samples))
                     real_samples = np.argmax(real_samples, axis=-1)
                     deco_samples = np.argmax(deco_samples, axis=-1)
@@ -897,11 +866,13 @@ class WGANGP2D_MPS(object):
               plots=True,
               num_plots=4,
               plot_freq=2,
-              reset_model=True):
-        
-        self.fit_gans(data_trn, data_val, epochs, best_acc, n_iterations, patience, split,
+              reset_model=True,
+              steps=None):
+        # data_trn: array or batch source (MPS_Generator, MPS_Memmap, iterator of batches), see GanData
+        data = AsGanData(data_trn, data_val, self.batch_size, split, steps)
+        self.fit_gans(data, None, epochs, best_acc, n_iterations, patience, split,
                       plots=plots, num_plots=num_plots, plot_freq=plot_freq, reset_model=reset_model)
-        self.fit_encoder(data_trn, data_val, epochs, best_acc, patience, split,
+        self.fit_encoder(data, None, epochs, best_acc, patience, split,
                          plots=plots, num_plots=num_plots, plot_freq=plot_freq, reset_model=reset_model)
         
     def fit_gans(self,
@@ -916,7 +887,8 @@ class WGANGP2D_MPS(object):
                  num_plots=4,
                  plot_freq=2,
                  th_acc = 90,
-                 reset_model=True):
+                 reset_model=True,
+                 steps=None):
         """
         optimize the discriminator and generators models using adversarial training
         """
@@ -932,15 +904,8 @@ class WGANGP2D_MPS(object):
             self.sess.run(init_gvars)
             print ("Initializing GANs models variables ...")      
         
-        # Setting training and validation samples
-        if data_val_ is None:
-            data_trn = data_trn_.copy()
-            np.random.shuffle(data_trn)
-            data_val = data_trn[int(split*len(data_trn)):]
-            data_trn = data_trn[:int(split*len(data_trn))]
-        else:
-            data_trn = data_trn_.copy()
-            data_val = data_val_.copy()            
+        # Setting training and validation samples (index permutations or batch source, see GanData)
+        data = AsGanData(data_trn_, data_val_, self.batch_size, split, steps)
         
         print("Starting GANs training ...")
         g_step = 0
@@ -957,8 +922,7 @@ class WGANGP2D_MPS(object):
             for _ in range(n_critic):
                 z_samples = np.random.normal(0, 1, size=[self.batch_size, self.z_size]).astype(np.float32)
                 # Select a random batch of images
-                idx = np.random.choice(data_trn.shape[0], self.batch_size, replace=False)
-                imgs = data_trn[idx]
+                imgs = data.random_batch()
                 # Update D network
                 _, d_loss = self.sess.run([d_optim, self.d_loss],
                                           feed_dict={self.real_img: imgs,
@@ -983,13 +947,11 @@ class WGANGP2D_MPS(object):
             # Reconstruction accuracy
             if (iteration+1) % (iterations) == 0:
                 # Select a random batch of images
-                idx = np.random.randint(0, data_val.shape[0], self.batch_size)
-                imgs = data_val[idx]
+                val_batch = data.val_sample()
                 self.sess.run(init_zvars)
-                np.random.shuffle(data_val)
                 for _ in range(n_iterations):                
                     _, g_loss_, acc_ = self.sess.run([z_optim, self.gz_loss, self.accuracy_z],
-                                                        feed_dict={self.real_img: data_val[:self.batch_size]})
+                                                        feed_dict={self.real_img: val_batch})
                 
                 # print('Iteration: ', iteration+1, '  G loss: ', g_loss_, '  Accuracy: ', acc_.mean())
                 if 100*np.mean(acc_) >= th_acc:
@@ -1018,8 +980,8 @@ class WGANGP2D_MPS(object):
         self.build_model(model_file=self.saving_path+self.name_base, model_file_enc=None, summary=False)
 
     def fit_encoder(self,
-                    data_trn,
-                    data_val=None,
+                    data_trn_,
+                    data_val_=None,
                     epochs=1,
                     best_acc=-np.inf,
                     patience=50,
@@ -1027,7 +989,8 @@ class WGANGP2D_MPS(object):
                     plots=True,
                     num_plots=4,
                     plot_freq=2,
-                    reset_model=True
+                    reset_model=True,
+                    steps=None
                     ):
 
         e_optim = tf.compat.v1.train.AdamOptimizer(self.e_lr, beta1=self.beta1).minimize(self.e_loss, var_list=self.e_vars)
@@ -1041,26 +1004,18 @@ class WGANGP2D_MPS(object):
             self.sess.run(init_op)
             print ("Initializing encoder variables ...")
 
-        # Setting training and validation samples
-        if data_val is None:
-            np.random.shuffle(data_trn)
-            data_val = data_trn[int(split*len(data_trn)):]
-            data_trn = data_trn[:int(split*len(data_trn))]
+        # Setting training and validation samples (index permutations or batch source, see GanData)
+        data = AsGanData(data_trn_, data_val_, self.batch_size, split, steps)
 
         print("Starting Encoder training ...")
         patience_trn = patience
         for epoch in range(10*epochs):
-            np.random.shuffle(data_trn)
-            number_of_batches = data_trn.shape[0] // self.batch_size
-            for index in range(0, number_of_batches):
-                volumes_batch = data_trn[index * self.batch_size:(index + 1) * self.batch_size]
+            for volumes_batch in data.batches():
                 self.sess.run([e_optim], 
                               feed_dict={self.real_img: volumes_batch})
             # Validation
-            number_of_batches = data_val.shape[0] // self.batch_size
             loss_E, loss_D, Acc = [], [], []
-            for index in range(0, number_of_batches):
-                volumes_batch = data_val[index * self.batch_size:(index + 1) * self.batch_size]
+            for index, volumes_batch in enumerate(data.batches(validation=True)):
                 errE, acc_e, deco_imgs = self.sess.run([self.e_loss, self.accuracy_e, self.deco_img],
                                                              feed_dict={self.real_img: volumes_batch})
                 loss_E.append(errE)
@@ -1073,7 +1028,7 @@ class WGANGP2D_MPS(object):
                 if self.saving_path:
                     Save_Model(self.encoder, self.saving_path + self.encoder_name)
                 if plots and index % plot_freq:
-                    real_samples = data_trn[:num_plots]
+                    real_samples = data.trn_sample(num_plots)
                     deco_samples = self.decoder.predict(self.encoder.predict(real_samples))
                     real_samples = np.argmax(real_samples, axis=-1)
                     deco_samples = np.argmax(deco_samples, axis=-1)
@@ -1257,7 +1212,8 @@ class AlphaGAN_MPS(object):
               plots=True,
               num_plots=4,
               plot_freq=2,
-              reset_model=True):
+              reset_model=True,
+              steps=None):
         """
         optimize the discriminator and generators models using adversarial training
         """
@@ -1273,28 +1229,18 @@ class AlphaGAN_MPS(object):
             self.sess.run(init_op)
             print ("Initializing GANs models variables ...")      
         
-        # Setting training and validation samples
-        if data_val_ is None:
-            data_trn = data_trn_.copy()
-            np.random.shuffle(data_trn)
-            data_val = data_trn[int(split*len(data_trn)):]
-            data_trn = data_trn[:int(split*len(data_trn))]
-        else:
-            data_trn = data_trn_.copy()
-            data_val = data_val_.copy()
+        # Setting training and validation samples (index permutations or batch source, see GanData)
+        data = AsGanData(data_trn_, data_val_, self.batch_size, split, steps)
             
         patience_trn = patience
         print("Starting GANs training ...")
         for epoch in range(epochs):
-            np.random.shuffle(data_trn)
-            np.random.shuffle(data_val)
-            batch_idxs = data_trn.shape[0] // self.batch_size
+            batch_idxs = data.num_batches
             loss_E, loss_G, loss_D, loss_C = [], [], [], []
 
-            for idx in range(0, batch_idxs):
+            for idx, volumes_batch in enumerate(data.batches()):
                 # Sample noise from a normal distribuition
                 z_samples = np.random.normal(0, 1, size=[self.batch_size, self.z_size]).astype(np.float32)
-                volumes_batch = data_trn[idx * self.batch_size:(idx + 1) * self.batch_size, :, :, :]
 
                 # 1. Update Encoder:
                 _, loss_e = self.sess.run([e_optim, self.e_loss],
@@ -1319,7 +1265,6 @@ class AlphaGAN_MPS(object):
                 loss_C.append(loss_c)
                 
                 if idx % (batch_idxs//4)==0 and epoch < 2 and plots:
-                    samples = data_trn[:num_plots]
                     zsamples = np.random.normal(0, 1, size=[num_plots, self.z_size]).astype(np.float32)
                     fake_volumes = self.decoder.predict(zsamples)
                     PlotDataAE([],np.argmax(fake_volumes, axis=-1), digit_size=(self.n_rows, self.n_cols), cmap='jet', Only_Result=False, num=num_plots)
@@ -1335,8 +1280,7 @@ class AlphaGAN_MPS(object):
                     
             with self.sess.as_default():
                 testing_acc = []
-                for i in range(len(data_val)//self.batch_size):
-                    x_test_batch = data_val[i * self.batch_size:(i + 1) * self.batch_size, :, :, :]
+                for x_test_batch in data.batches(validation=True):
                     testing_acc.append(self.accuracy.eval({self.real_img: x_test_batch}))
                 test_acc = np.mean(testing_acc)
                 print('Acc -->', test_acc)
@@ -1350,7 +1294,7 @@ class AlphaGAN_MPS(object):
                         Save_Model(self.decoder, self.saving_path+self.decoder_name)
                         Save_Model(self.discriminator, self.saving_path+self.discriminator_name)
                         Save_Model(self.code_discriminator, self.saving_path+self.code_discriminator_name)
-                    real_samples = data_val[:num_plots]
+                    real_samples = data.val_sample(num_plots)
                     x_hat = self.decoder.predict(self.encoder.predict(real_samples))
                     PlotDataAE(np.argmax(real_samples, axis=-1), np.argmax(x_hat, axis=-1), digit_size=(self.n_rows, self.n_cols), cmap='jet', Only_Result=True, num=num_plots)    
                 else:
@@ -1451,7 +1395,7 @@ class CycleGAN_MPS(object):
         print('Building pca model ...')
         data = np.expand_dims(np.argmax(data, axis=-1), axis=-1)
         trn_data, val_data = self.utils.split_data(data, self.Nr)
-        pca_model = ComputePCA(trn_data, epsilon=self.epsilon, computeAll=True)
+        pca_model = ComputePCA(trn_data, epsilon=self.epsilon, computeAll=True, lowRank=True)
         pca_realizations = self.utils.random_pca_realizations((self.n_rows, self.n_cols), pca_model, self.Nt, plots=plots)
         trn_data_pca = self.utils.map2pca(trn_data, (self.n_rows, self.n_cols), pca_model, plots=plots)
         val_data_pca = self.utils.map2pca(val_data, (self.n_rows, self.n_cols), pca_model, plots=plots)
@@ -11,8 +11,10 @@ import scipy.io as sio
 import matplotlib.pyplot as plt
 import tensorflow as tf
 import os
+import glob
+import multiprocessing
 
-from keras.utils import to_categorical
+from keras.utils import to_categorical, Sequence
 from sklearn.model_selection import train_test_split
 from tensorflow.python.keras.utils.data_utils import get_file
 import requests
@@ -142,14 +144,11 @@ def LoadMPS100(dirBase='/work/Home89/PythonUtils/DataSetThesis/MPS100.mat',Short
         original_img_size = (1, 100, 100)
     else:
         original_img_size = (100, 100, 1)
-    x_Facies = {}
-    f = h5py.File(dirBase)
-    for k, v in f.items():
-        x_Facies[k] = np.array(v)      
-    x_Facies=x_Facies['Dato'].astype('float32')
-    f.close()
+    # Only the requested rows of 'Dato' are read (see MPS_Memmap for datasets larger than memory)
+    f = h5py.File(dirBase, 'r')
+    x_Facies = f['Dato']
     if AllTrain :
-        x_train =x_Facies
+        x_train =x_Facies[:]
     else :
         if ShortDate :
             x_train =x_Facies[0:5000]
@@ -157,6 +156,7 @@ def LoadMPS100(dirBase='/work/Home89/PythonUtils/DataSetThesis/MPS100.mat',Short
             x_train =x_Facies[0:32000]
             
     x_test  =x_Facies[32000:40000]
+    f.close()
     x_train = x_train.reshape((x_train.shape[0],) + (original_img_size))
     x_test =  x_test.reshape((x_test.shape[0],) + (original_img_size))
     x_train = x_train.astype('float32')
@@ -259,9 +259,20 @@ def _int64_feature(value):
 def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
-def convert_to(data_set, name, path_download):
+def encode_facies(image, encoding):
+    """One-hot image (h, w, facies) as bytes: 'onehot', 'index' (facies code per cell) or 'bits' (2 facies, 1 bit per cell)"""
+    if encoding == 'onehot':
+        return image.astype(np.uint8).tostring()
+    index = np.argmax(image, axis=-1).astype(np.uint8)
+    if encoding == 'index':
+        return index.tostring()
+    return np.packbits(index.ravel()).tostring()
+
+def convert_to(data_set, name, path_download, encoding = 'onehot', compression = None):
     
-    """Converts a dataset to tfrecords."""
+    """Converts a dataset to tfrecords.
+    encoding: 'onehot' (one-hot uint8), 'index' (uint8 facies code) or 'bits' (binary facies packed 8 cells per byte).
+    compression: None or 'GZIP' (written as name.tfrecords.gz). MPS_Generator expands 'index' and 'bits' back to one-hot."""
     
     images = data_set
 
@@ -270,67 +281,197 @@ def convert_to(data_set, name, path_download):
     cols = images.shape[2]
     depth = images.shape[3]
 
-    filename = os.path.join(path_download, name + '.tfrecords')
+    if encoding not in ('onehot', 'index', 'bits'):
+        raise ValueError("encoding must be 'onehot', 'index' or 'bits'")
+    if encoding != 'onehot' and depth < 2:
+        raise ValueError("encoding '%s' needs one-hot facies (depth >= 2)" % encoding)
+    if encoding == 'bits' and depth != 2:
+        raise ValueError("encoding 'bits' needs 2 facies")
+
+    filename = os.path.join(path_download, name + tfrecords_suffix(compression))
     print('Writing', filename)
-    
-    with tf.python_io.TFRecordWriter(filename) as writer:
+
+    options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.GZIP) if compression == 'GZIP' else None
+    with tf.python_io.TFRecordWriter(filename, options=options) as writer:
         for index in range(num_examples):
             
-            image_raw = images[index].astype(np.uint8)
-        
-            image_raw = image_raw.tostring()
-            example = tf.train.Example(features=tf.train.Features(feature={
+            image_raw = encode_facies(images[index], encoding)
+            feature = {
                 'height': _int64_feature(rows),
                 'width': _int64_feature(cols),
                 'depth': _int64_feature(depth),
                 'image_raw': _bytes_feature(image_raw),
                 'num_samples': _int64_feature(num_examples)
-                }))
+                }
+            if encoding != 'onehot':
+                feature['encoding'] = _bytes_feature(encoding.encode())
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
             writer.write(example.SerializeToString())
-
-
-def convert_to_tfrecords(path, x_train, x_test_val):
-    convert_to(x_train, 'train', path)
-    convert_to(x_test_val, 'test_val', path)
+    return filename
+
+
+def write_shard(task):
+    # Worker of convert_to_shards: one shard, data read by chunks (memory map when data is a .npy path)
+    data, index, filename, encoding, compression, num_facies, chunk_size = task
+    if isinstance(data, str):
+        data = np.load(data, mmap_mode='r')
+    options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.GZIP) if compression == 'GZIP' else None
+    with tf.python_io.TFRecordWriter(filename, options=options) as writer:
+        for start in range(0, len(index), chunk_size):
+            images = np.asarray(data[index[start:start + chunk_size]])
+            if not (images.ndim == 4 and images.shape[-1] > 1):
+                # Facies codes (N, h, w[, 1]) to one-hot
+                images = images.reshape(images.shape[:3])[..., None] == np.arange(num_facies)
+            rows, cols, depth = images.shape[1:]
+            for image in images:
+                feature = {
+                    'height': _int64_feature(rows),
+                    'width': _int64_feature(cols),
+                    'depth': _int64_feature(depth),
+                    'image_raw': _bytes_feature(encode_facies(image, encoding)),
+                    'num_samples': _int64_feature(len(index))
+                    }
+                if encoding != 'onehot':
+                    feature['encoding'] = _bytes_feature(encoding.encode())
+                example = tf.train.Example(features=tf.train.Features(feature=feature))
+                writer.write(example.SerializeToString())
+    return filename
+
+def convert_to_shards(data, name, path_download, num_shards = 4, workers = None, index = None, encoding = 'onehot',
+                      compression = None, num_facies = 2, chunk_size = 1000):
+
+    """Converts data[index] to num_shards tfrecords (name-00000-of-00004.tfrecords, ...) written in parallel
+    by workers processes (default: one per shard, up to the number of cpus).
+    data: path of a .npy (memory-mapped by each worker) or array, facies codes or one-hot.
+    num_samples of each record is the size of its shard, MPS_Generator adds the shards."""
+
+    if encoding not in ('onehot', 'index', 'bits'):
+        raise ValueError("encoding must be 'onehot', 'index' or 'bits'")
+    if encoding == 'bits' and num_facies != 2:
+        raise ValueError("encoding 'bits' needs 2 facies")
+    num = (np.load(data, mmap_mode='r') if isinstance(data, str) else data).shape[0]
+    index = np.arange(num) if index is None else np.sort(index)
+
+    tasks = []
+    for shard, shard_index in enumerate(np.array_split(index, num_shards)):
+        filename = os.path.join(path_download, '%s-%05d-of-%05d%s' % (name, shard, num_shards, tfrecords_suffix(compression)))
+        # Arrays are sent shard by shard, paths are opened in the workers
+        shard_data = data if isinstance(data, str) else np.asarray(data[shard_index])
+        shard_index = shard_index if isinstance(data, str) else np.arange(len(shard_index))
+        tasks.append((shard_data, shard_index, filename, encoding, compression, num_facies, chunk_size))
+
+    pool = multiprocessing.Pool(min(workers or num_shards, num_shards, multiprocessing.cpu_count()))
+    try:
+        for filename in pool.imap_unordered(write_shard, tasks):
+            print('Writing', filename)
+    finally:
+        pool.close()
+        pool.join()
+    return [task[2] for task in tasks]
+
+def list_tfrecords(path):
+    """Files of a dataset: path of a tfrecords, glob pattern ('train-*.tfrecords') or list of shards"""
+    if isinstance(path, (list, tuple)):
+        return list(path)
+    if glob.has_magic(path):
+        files = sorted(glob.glob(path))
+        if not files:
+            raise IOError('No tfrecords match ' + path)
+        return files
+    return [path]
+
+def convert_to_tfrecords(path, x_train, x_test_val, encoding = 'onehot', compression = None):
+    convert_to(x_train, 'train', path, encoding, compression)
+    convert_to(x_test_val, 'test_val', path, encoding, compression)
     #convert_to(x_test, 'test', path)
 
 def load_from_tfrecords(path, batch_size):
     path_train = os.path.join(path, 'train.tfrecords')
     #path_val = os.path.join(path, 'val.tfrecords')
     path_test = os.path.join(path, 'test_val.tfrecords')
+    # GZIP (.tfrecords.gz) or sharded datasets (convert_to_shards)
+    if not os.path.exists(path_train):
+        path_train = path_train + '.gz' if os.path.exists(path_train + '.gz') else os.path.join(path, 'train-*-of-*.tfrecords*')
+    if not os.path.exists(path_test):
+        path_test = path_test + '.gz' if os.path.exists(path_test + '.gz') else os.path.join(path, 'test_val-*-of-*.tfrecords*')
     gen_train = MPS_Generator(path_train, batch_size)
     #gen_val = MPS_Generator(path_val, batch_size)
     gen_test = MPS_Generator(path_test, batch_size)
 
     return gen_train, gen_test
 
+FEATURES = {
+    'image_raw': tf.FixedLenFeature([], tf.string),
+    'height': tf.FixedLenFeature([],tf.int64),
+    'width': tf.FixedLenFeature([],tf.int64),
+    'depth': tf.FixedLenFeature([],tf.int64),
+    'num_samples': tf.FixedLenFeature([],tf.int64)
+}
+
+def tfrecords_suffix(compression):
+    return '.tfrecords.gz' if compression == 'GZIP' else '.tfrecords'
+
+def compression_type(path, compression = None):
+    # Recorded in the name by convert_to ('.gz' suffix) unless given ('GZIP' or '')
+    if compression is not None:
+        return compression or ''
+    return 'GZIP' if path.endswith('.gz') else ''
+
+def read_header(path, compression = None):
+    """(height, width, depth, num_samples, encoding) from the first record, without a session"""
+    options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.GZIP) if compression_type(path, compression) else None
+    record = next(tf.python_io.tf_record_iterator(path, options=options))
+    feature = tf.train.Example.FromString(record).features.feature
+    encoding = feature['encoding'].bytes_list.value[0].decode() if 'encoding' in feature else 'onehot'
+    return tuple(feature[key].int64_list.value[0] for key in ['height', 'width', 'depth', 'num_samples']) + (encoding, )
+
 class MPS_Generator():
 
-    """Class to create a generator to train with tfrecords"""
+    """Class to create a generator to train with tfrecords.
+    path: tfrecords file, glob pattern or list of shards (convert_to_shards)
+    compression: 'GZIP' or '' (default: GZIP for .gz files)"""
     
-    def __init__(self, path = '', _batch_size = 10):
-          
-        self.dataset = tf.data.TFRecordDataset(path).map(self.decode_example).repeat().shuffle(42).batch(_batch_size)
+    def __init__(self, path = '', _batch_size = 10, shuffle_buffer = 4096, num_parallel_calls = tf.data.experimental.AUTOTUNE,
+                 prefetch = tf.data.experimental.AUTOTUNE, seed = None, cycle_length = 4, compression = None):
+
+        files = list_tfrecords(path)
+        headers = [read_header(file, compression) for file in files]
+        height, width, depth, _, self.encoding = headers[0]
+        if any(header[:3] + header[4:] != headers[0][:3] + headers[0][4:] for header in headers):
+            raise ValueError('Shards with different image dimensions or encodings')
+        self.num = sum(header[3] for header in headers)
+        self.image_dim = (height, width, depth)
         self._batch_size = _batch_size
-        
-        _iter = self.dataset.make_one_shot_iterator()
-        batch = _iter.get_next()
-        first_bacth = K.batch_get_value(batch)
-        self.image_dim = first_bacth[0].shape[1:]       
-        self.num = np.unique(first_bacth[1])[0]
+        self.files = files
+        self.options = (shuffle_buffer, num_parallel_calls, prefetch, seed, cycle_length, compression)
+        self.dataset = self.make_dataset()
+
+    def make_dataset(self):
+        # Pipeline in the current default graph
+        files, _batch_size = self.files, self._batch_size
+        shuffle_buffer, num_parallel_calls, prefetch, seed, cycle_length, compression = self.options
+
+        # Shuffle of the records before repeat (new order every epoch), then the parsing of whole batches
+        # in parallel (parse_example + decode_raw on the batch vector) and prefetch of the next batches
+        if len(files) == 1:
+            dataset = tf.data.TFRecordDataset(files[0], compression_type=compression_type(files[0], compression))
+        else:
+            # Shards read in parallel, records interleaved (shard order reshuffled every epoch)
+            dataset = tf.data.Dataset.from_tensor_slices(files)
+            if shuffle_buffer:
+                dataset = dataset.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+            compression = compression_type(files[0], compression)
+            dataset = dataset.interleave(lambda file: tf.data.TFRecordDataset(file, compression_type=compression),
+                                         cycle_length=min(cycle_length, len(files)), num_parallel_calls=num_parallel_calls)
+        if shuffle_buffer:
+            dataset = dataset.shuffle(min(shuffle_buffer, self.num), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.repeat().batch(_batch_size)
+        dataset = dataset.map(self.decode_batch, num_parallel_calls=num_parallel_calls)
+        return dataset.prefetch(prefetch)
 
     def decode_example(self, example_proto):
 
-        features = tf.parse_single_example(
-            example_proto,
-            features = {
-                'image_raw': tf.FixedLenFeature([], tf.string),
-                'height': tf.FixedLenFeature([],tf.int64),
-                'width': tf.FixedLenFeature([],tf.int64),
-                'depth': tf.FixedLenFeature([],tf.int64),
-                'num_samples': tf.FixedLenFeature([],tf.int64)
-          }
-        )
+        features = tf.parse_single_example(example_proto, features = FEATURES)
 
         image = tf.decode_raw(features['image_raw'], tf.uint8)
         image = tf.reshape(image, (features['height'], features['width'], features['depth']))
@@ -339,26 +480,141 @@ class MPS_Generator():
 
         return [image, num]
 
-    def mps_generator(self):
+    def decode_batch(self, examples_proto):
+
+        features = tf.parse_example(examples_proto, features = {'image_raw': FEATURES['image_raw']})
+        image = tf.decode_raw(features['image_raw'], tf.uint8)
+        if self.encoding == 'onehot':
+            return tf.reshape(image, (-1, ) + self.image_dim)
+
+        height, width, depth = self.image_dim
+        if self.encoding == 'bits':
+            # Unpacking of the 8 cells of each byte (most significant bit first, as np.packbits)
+            shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+            image = tf.bitwise.bitwise_and(tf.bitwise.right_shift(image[..., None], shifts), 1)
+            image = tf.reshape(image, (tf.shape(image)[0], -1))[:, :height * width]
+        index = tf.reshape(image, (-1, height, width))
+        return tf.one_hot(index, depth, dtype=tf.uint8)
+
+    def keras_dataset(self, dtype = tf.float32):
+        # (x, x) batches for models consuming datasets directly (tf.keras fit(dataset, steps_per_epoch=len(gen)))
+        return self.dataset.map(lambda x: (tf.cast(x, dtype), tf.cast(x, dtype)))
+
+    def numpy_iterator(self):
+        # Numpy batches read in a graph and session of their own: the iterator survives
+        # K.clear_session() (build_model of the Gans) while the training uses it
+        graph = tf.Graph()
+        with graph.as_default():
+            batch = self.make_dataset().make_one_shot_iterator().get_next()
+        sess = tf.Session(graph=graph)
+        try:
+            while True:
+                yield sess.run(batch)
+        finally:
+            sess.close()
 
-        _iter = self.dataset.make_one_shot_iterator()
-        batch = _iter.get_next()
+    def mps_generator(self):
 
-        while True:
-            x = K.batch_get_value(batch)[0]
+        for x in self.numpy_iterator():
             yield (x, x)
 
     def get_numpy_batch(self):
 
-        _iter = self.dataset.make_one_shot_iterator()
-        batch = _iter.get_next()
-        x = K.batch_get_value(batch)[0]
+        _iter = self.numpy_iterator()
+        x = next(_iter)
+        _iter.close()
+        return x
+
+    def numpy_batches(self, num_batches=None):
+        # One pass (len(self) batches by default) as numpy arrays, e.g. for ComputePCA(method='incremental')
+        _iter = self.numpy_iterator()
+        for _ in range(num_batches or len(self)):
+            yield next(_iter)
+        _iter.close()
+
+    def __len__(self):
+        return self.num // self._batch_size
+
+
+class MPS_Memmap(Sequence):
+
+    """Memory-mapped .npy dataset: facies codes (N, h, w[, 1]) or one-hot (N, h, w, facies).
+    Only the sampled batches are read from disk and expanded to one-hot.
+    Keras Sequence of (x, x) batches for fit_generator, with a new order every epoch."""
+
+    def __init__(self, path = '', _batch_size = 10, num_facies = 2, isTanh = False, dtype = None, seed = None):
+
+        self.data = np.load(path, mmap_mode='r')
+        self.isOneHot = self.data.ndim == 4 and self.data.shape[-1] > 1
+        self.num = self.data.shape[0]
+        self.image_dim = self.data.shape[1:3] + ((self.data.shape[-1], ) if self.isOneHot else (num_facies, ))
+        self._batch_size = _batch_size
+        self.isTanh = isTanh
+        self.dtype = dtype or ('float32' if isTanh else 'uint8')
+        self.rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def get_batch(self, index):
+        # Sorted indices: sequential reads of the memory map
+        x = self.data[np.sort(index)]
+        if not self.isOneHot:
+            x = (x.reshape(x.shape[:3])[..., None] == np.arange(self.image_dim[-1], dtype=x.dtype))
+        x = x.astype(self.dtype)
+        if self.isTanh:
+            x = 2 * x - 1
         return x
 
+    def sample_batch(self, batch_size = None):
+        """Random batch (without replacement)"""
+        return self.get_batch(self.rng.choice(self.num, batch_size or self._batch_size, replace=False))
+
+    def on_epoch_end(self):
+        self.permutation = self.rng.permutation(self.num)
+
+    def __getitem__(self, index):
+        x = self.get_batch(self.permutation[index * self._batch_size:(index + 1) * self._batch_size])
+        return (x, x)
+
+    def mps_generator(self):
+
+        while True:
+            for index in range(len(self)):
+                yield self[index]
+            self.on_epoch_end()
+
+    def get_numpy_batch(self):
+        return self.get_batch(np.arange(self.num))
+
+    def numpy_batches(self, num_batches=None):
+        for index in range(num_batches or len(self)):
+            yield self[index % len(self)][0]
+
     def __len__(self):
         return self.num // self._batch_size
 
 
+def convert_to_npy(data, path, index = None, chunk_size = 1000, shape = None):
+
+    """Writes data[index] (numpy array, memory map or HDF5 dataset, facies codes or one-hot)
+    as uint8 facies codes (N, h, w) in path, chunk_size samples at a time.
+    shape: (h, w) of flattened samples (default: square grid, as the 'Dato' of LoadMPS100)"""
+
+    index = np.arange(data.shape[0]) if index is None else np.sort(index)
+    sample = np.asarray(data[index[:1]])
+    isOneHot = sample.ndim == 4 and sample.shape[-1] > 1
+    if shape is None:
+        shape = sample.shape[1:3] if sample.ndim > 2 else (int(np.sqrt(sample.shape[1])), ) * 2
+    print('Writing', path)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(index), ) + shape)
+    for start in range(0, len(index), chunk_size):
+        x = np.asarray(data[index[start:start + chunk_size]])
+        if isOneHot:
+            x = np.argmax(x, axis=-1)
+        out[start:start + chunk_size] = x.reshape((-1, ) + shape)
+    out.flush()
+    return out
+
+
 def GetPCAComponents(diagonal,epsilon):
     sum_diagonal    = np.sum(diagonal)
     cumsum_diagonal = np.cumsum(diagonal)
@@ -14,15 +14,113 @@ def GetPCAComponentsNr(diagonal, Nc=70):
     return np.diag(diagonal[0:Nc])
 
 
-def ComputePCA(data, epsilon=0.4, Nc=70, computeAll=True):
-    data_vector = data.reshape(-1, np.prod(data.shape[-3:]))
-    mean_ = np.mean(data_vector, axis=0)
-    data_c = data_vector-mean_
-    const = 1/np.sqrt(data.shape[0]-1)
+class LowRankProjector:
+    """Matrix left @ right kept as its rank-r factors: dot costs O(N x r) per column"""
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.shape = (left.shape[0], right.shape[1])
+
+    def dot(self, x):
+        return np.dot(self.left, np.dot(self.right, x))
+
+    @property
+    def T(self):
+        return LowRankProjector(self.right.T, self.left.T)
+
+    def __array__(self, dtype=None):
+        # Dense N x N matrix, only for code still calling np.dot(Us, x)
+        return np.asarray(np.dot(self.left, self.right), dtype=dtype)
+
+
+def GetPCAComponentsVariance(diagonal, total, epsilon=0.5):
+    # Energy fraction on the variance (s**2), total = ||data_c||_F**2: available to the
+    # approximate methods, unlike the sum of all the singular values used by GetPCAComponents
+    result = np.cumsum(diagonal**2)/total
+    Nr = result[result < epsilon].shape[0]
+    return np.diag(diagonal[0:min(Nr+1, len(diagonal))])
+
+
+def RandomizedSVD(data_c, epsilon=0.4, Nc=70, computeAll=True, n_components=64, n_iter=4, seed=0):
+    """Components (features, k) and singular values of data_c (samples, features)"""
+    from sklearn.utils.extmath import randomized_svd
+    total = np.sum(data_c**2)
+    k = Nc if not computeAll else n_components
+    while True:
+        k = min(k, min(data_c.shape))
+        _, s, V = randomized_svd(data_c, k, n_iter=n_iter, random_state=seed)
+        # Rank doubled until the requested energy fraction is reached
+        if not computeAll or k == min(data_c.shape) or np.sum(s**2)/total >= epsilon:
+            return V.T, s, total
+        k *= 2
+
+
+def IncrementalSVD(batches, epsilon=0.4, Nc=70, computeAll=True, n_components=None):
+    """
+    Mini-batch PCA over an iterable of arrays (samples, ...) such as MPS_Generator.numpy_batches().
+    Returns components (features, k), singular values, mean, number of samples and total variance.
+    With computeAll the k components (n_components, default the size of the first batch) must
+    hold the epsilon variance fraction, otherwise ValueError (give a larger n_components).
+    """
+    from sklearn.decomposition import IncrementalPCA
+    ipca = None
+    pending = None
+    for batch in batches:
+        batch = batch.reshape(batch.shape[0], -1).astype(np.float64)
+        if ipca is None:
+            k = Nc if not computeAll else (n_components or min(batch.shape))
+            ipca = IncrementalPCA(n_components=k)
+        # partial_fit needs at least k samples: small batches are merged with the next one
+        if pending is not None and pending.shape[0] >= ipca.n_components and batch.shape[0] >= ipca.n_components:
+            ipca.partial_fit(pending)
+            pending = batch
+        else:
+            pending = batch if pending is None else np.concatenate([pending, batch])
+    ipca.partial_fit(pending)
+    total = np.sum(ipca.var_)*ipca.n_samples_seen_
+    captured = np.sum(ipca.singular_values_**2)/total
+    if computeAll and captured < epsilon and ipca.n_components < min(ipca.n_samples_seen_, ipca.n_features_in_):
+        raise ValueError('IncrementalSVD: %i components hold %.3f of the variance, less than epsilon=%g; '
+                         'give a larger n_components' % (ipca.n_components, captured, epsilon))
+    return ipca.components_.T, ipca.singular_values_, ipca.mean_, ipca.n_samples_seen_, total
+
+
+def ComputePCA(data, epsilon=0.4, Nc=70, computeAll=True, lowRank=False, method='exact', n_components=None, seed=0,
+               criterion='singular'):
+    # lowRank (with computeAll): Us and Us_inv as LowRankProjector instead of N x N matrices
+    # method: 'exact' (full SVD), 'randomized' or 'incremental' (data can be an iterable of batches,
+    # data_c is then None)
+    # criterion (with computeAll), the same for every method: 'singular' keeps the components up to
+    # epsilon of the sum of the singular values (GetPCAComponents, needs the full SVD: 'exact' only),
+    # 'variance' up to epsilon of the variance, sum of s**2 (GetPCAComponentsVariance)
+    if criterion not in ('singular', 'variance'):
+        raise ValueError("criterion must be 'singular' or 'variance'")
+    if computeAll and criterion == 'singular' and method != 'exact':
+        raise ValueError("criterion 'singular' needs method='exact', use criterion='variance'")
+    if method == 'incremental' and not isinstance(data, np.ndarray):
+        U, s, mean_, num_samples, total = IncrementalSVD(data, epsilon, Nc, computeAll, n_components)
+        data_c = None
+    else:
+        data_vector = data.reshape(-1, np.prod(data.shape[-3:]))
+        num_samples = data_vector.shape[0]
+        mean_ = np.mean(data_vector, axis=0)
+        data_c = data_vector-mean_
+        if method == 'exact':
+            U, s, V = svd(data_c.T, full_matrices=False)
+            total = np.sum(s**2)
+        elif method == 'randomized':
+            U, s, total = RandomizedSVD(data_c, epsilon, Nc, computeAll, n_components or 64, seed=seed)
+        elif method == 'incremental':
+            batch_size = max(n_components or 0, Nc if not computeAll else 0, 1000)
+            batches = (data_vector[i:i + batch_size] for i in range(0, num_samples, batch_size))
+            U, s, _, _, total = IncrementalSVD(batches, epsilon, Nc, computeAll, n_components)
+        else:
+            raise ValueError("method must be 'exact', 'randomized' or 'incremental'")
+    const = 1/np.sqrt(num_samples-1)
+    dim = U.shape[0]
 
-    U, s, V = svd(data_c.T, full_matrices=False)
     if computeAll:
-        S = GetPCAComponents(s, epsilon=epsilon)
+        S = GetPCAComponents(s, epsilon=epsilon) if criterion == 'singular' else GetPCAComponentsVariance(s, total, epsilon)
     else:
         S = GetPCAComponentsNr(s, Nc=Nc)
     nz = S.shape[0]
@@ -33,8 +131,12 @@ def ComputePCA(data, epsilon=0.4, Nc=70, computeAll=True):
     Si = np.diag(s[:nz]**(-1))
     Us_inv = np.dot(Si, U_.T)
 
-    if computeAll:
+    if computeAll and lowRank:
+        Us = LowRankProjector(Us, U_.T)
+        Us_inv = LowRankProjector(U_, Us_inv)
+        nz = dim
+    elif computeAll:
         Us = np.dot(Us, U_.T)
         Us_inv = np.dot(U_, Us_inv)
-        nz = data.shape[-1]*data.shape[-2]*data.shape[-3]
+        nz = dim
     return Us, Us_inv, const, nz, mean_, data_c
@@ -1,19 +1,24 @@
 import argparse
+import os
+import h5py
 import numpy as np
-from Utils import convert_to
+from Utils import convert_to, convert_to_npy, convert_to_shards
 from sklearn.model_selection import train_test_split
 from keras.utils import to_categorical
 
 
 # cd 'GeoFacies/GeoFaciesICA/GeoFacies_DL/Model'
 # python convert_data.py --dataset_path_input '/share/GeoFacies/DataSet/MPS45/MPS45.npy' --dataset_path_output '../../../Maykol/dataset/MPS45' --split
+# Memory-mapped uint8 facies codes for MPS_Memmap, also from the HDF5 .mat files: --format npy [--key Dato]
+# Binary facies packed 8 cells per byte and GZIP (16x+ smaller than one-hot, written as .tfrecords.gz): --encoding bits --compression GZIP
+# Large datasets: memory-mapped input written in parallel to shards train-0000i-of-0000n.tfrecords: --shards 8 [--workers 4]
 
 def get_args():
 
     parser = argparse.ArgumentParser(description="Convert to tfrecords from numpy - Geofacies",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--dataset_path_input", type=str, required=True, default = "",
-                        help="dataset path (numpy)")
+                        help="dataset path (numpy, or HDF5 .mat/.h5 with --format npy)")
     parser.add_argument("--dataset_path_output", type=str, required=True, default = "",
                         help="dataset path (tfrecorfs)")
     parser.add_argument("--split", action='store_true',
@@ -24,14 +29,60 @@ def get_args():
                         help="random seed")
     parser.add_argument("--model", type=str, default="cvae",
                         help="model architecture ('cvae','cvae_style','CycleGAN')")
+    parser.add_argument("--encoding", type=str, default="onehot",
+                        help="storage of the facies ('onehot', 'index' or 'bits' for binary facies)")
+    parser.add_argument("--compression", type=str, default=None,
+                        help="record compression (None or 'GZIP')")
+    parser.add_argument("--format", type=str, default="tfrecords",
+                        help="output format ('tfrecords' or 'npy' memory map)")
+    parser.add_argument("--key", type=str, default="Dato",
+                        help="dataset of the HDF5 input")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="number of tfrecords shards written in parallel (0: single file)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes writing the shards (default: one per shard, up to the number of cpus)")
     args = parser.parse_args()
     
     return args
 
 
+def convert_npy(args):
+    # Samples are read and written by chunks, the dataset is never loaded in memory
+    if args.dataset_path_input.endswith('.npy'):
+        data = np.load(args.dataset_path_input, mmap_mode='r')
+    else:
+        data = h5py.File(args.dataset_path_input, 'r')[args.key]
+    index = np.arange(data.shape[0])
+    if args.split:
+        index, index_test = train_test_split(index, test_size=args.test_size, random_state=args.random_state)
+        convert_to_npy(data, os.path.join(args.dataset_path_output, 'test_val.npy'), index_test)
+    convert_to_npy(data, os.path.join(args.dataset_path_output, 'train.npy'), index)
+
+
+def convert_shards(args):
+    # The input .npy is memory-mapped, each process reads its shard by chunks
+    if args.model == "cvae_style":
+        raise ValueError("--shards writes one-hot facies, not the cvae_style [-1, 1] channel")
+    num = np.load(args.dataset_path_input, mmap_mode='r').shape[0]
+    index = np.arange(num)
+    if args.split:
+        index, index_test = train_test_split(index, test_size=args.test_size, random_state=args.random_state)
+        convert_to_shards(args.dataset_path_input, 'test_val', args.dataset_path_output, args.shards, args.workers,
+                          index_test, args.encoding, args.compression)
+    convert_to_shards(args.dataset_path_input, 'train', args.dataset_path_output, args.shards, args.workers,
+                      index, args.encoding, args.compression)
+
+
 def main():
     args = get_args()
 
+    if args.format == 'npy':
+        convert_npy(args)
+        return
+    if args.shards:
+        convert_shards(args)
+        return
+
     data = np.load(args.dataset_path_input)
     data = to_categorical(data,2)
 
@@ -39,14 +90,15 @@ def main():
         data = np.argmax(data,axis=-1)
         data = np.expand_dims(data, axis=-1)
         data = 2*data-1
+        args.encoding = 'onehot'  # single channel in [-1, 1], stored as is
 
     if args.split:
         x_train, x_test  = train_test_split(data, test_size=args.test_size, random_state=args.random_state)
-        convert_to(x_test, 'test_val', args.dataset_path_output)
+        convert_to(x_test, 'test_val', args.dataset_path_output, args.encoding, args.compression)
     else:
         x_train = data
 
-    convert_to(x_train, 'train', args.dataset_path_output)
+    convert_to(x_train, 'train', args.dataset_path_output, args.encoding, args.compression)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import time
+import tensorflow as tf
+import keras.backend as K
+from keras.models import model_from_json
+from tensorflow.python.tools import optimize_for_inference_lib
+from Model.BiLinearUp import BilinearUpsampling
+from keras_contrib.layers.normalization.instancenormalization import InstanceNormalization
+from HistoryMatching.ModelDL import LoadModelTF, relu6
+
+
+# python -m Model.freeze_model --model_path Model/TrainModel/CVAE100 --output_path Model/TrainModel/CVAE100_tf
+# Converts the encoder/decoder pair saved by Save_Model into frozen inference graphs (.pb)
+# and writes the manifest read by HistoryMatching.ModelDL.LoadModelTF
+
+def get_args():
+
+    parser = argparse.ArgumentParser(description="Freeze trained encoder/decoder networks for inference - Geofacies",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="network path used in Save_Model (without _encoder/_decoder)")
+    parser.add_argument("--output_path", type=str, required=True,
+                        help="output directory of the frozen graphs")
+    parser.add_argument("--model_dim", type=str, default=None,
+                        help="dimension of the facies model (default: from the encoder input)")
+    parser.add_argument("--isTanh", action='store_true',
+                        help="encoder input scaled to [-1, 1]")
+    parser.add_argument("--check", action='store_true',
+                        help="time the loading of the frozen decoder")
+    args = parser.parse_args()
+
+    return args
+
+
+def load_keras(model_name):
+    with open(model_name + '.json', 'r') as json_file:
+        model = model_from_json(json_file.read(), custom_objects={'BilinearUpsampling': BilinearUpsampling, 'relu6': relu6,
+                                                                      'InstanceNormalization': InstanceNormalization})
+    model.load_weights(model_name + '_weights.hdf5')
+    return model
+
+
+def freeze(model_name, path_pb):
+    """Freezes model_name in inference mode: variables to constants, training nodes stripped"""
+    K.clear_session()
+    K.set_learning_phase(0)
+    model = load_keras(model_name)
+    sess = K.get_session()
+
+    input_name = model.inputs[0].op.name
+    output_name = model.outputs[0].op.name
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), [output_name])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+    graph_def = optimize_for_inference_lib.optimize_for_inference(graph_def, [input_name], [output_name],
+                                                                  model.inputs[0].dtype.as_datatype_enum)
+    tf.train.write_graph(graph_def, os.path.dirname(path_pb), os.path.basename(path_pb), as_text=False)
+    return input_name + ':0', output_name + ':0', model.input_shape, model.output_shape
+
+
+def main():
+    args = get_args()
+    if not os.path.exists(args.output_path):
+        os.makedirs(args.output_path)
+    name = os.path.basename(args.model_path)
+
+    manifest = {'path_tf_red_decoder': name + '_decoder.pb'}
+    manifest['decoder_in'], manifest['name_decoder'], _, output_shape = freeze(args.model_path + '_decoder',
+                                                                 os.path.join(args.output_path, manifest['path_tf_red_decoder']))
+    if os.path.exists(args.model_path + '_encoder.json'):
+        manifest['path_tf_red_encoder'] = name + '_encoder.pb'
+        manifest['encoder_in'], manifest['name_encoder'], input_shape, _ = freeze(args.model_path + '_encoder',
+                                                                               os.path.join(args.output_path, manifest['path_tf_red_encoder']))
+        manifest['NumFacies'] = input_shape[-1]
+    else:
+        # Decoder only (Gans): facies model from the decoder output, (N, x, y[, z], facies)
+        # with a single channel for binary facies (sign of the output)
+        input_shape = output_shape
+        manifest['NumFacies'] = max(output_shape[-1], 2)
+    if args.model_dim is None:
+        manifest['Model_Dim'] = list(input_shape[1:3]) + [1 if len(input_shape) == 4 else input_shape[3]]
+    else:
+        manifest['Model_Dim'] = [int(i) for i in args.model_dim.split('-')]
+    manifest['isTanh'] = args.isTanh
+
+    path_manifest = os.path.join(args.output_path, name + '_tf.json')
+    with open(path_manifest, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    print('Writing', path_manifest)
+
+    if args.check:
+        K.clear_session()
+        start = time.perf_counter()
+        LoadModelTF(path_manifest)
+        print('Frozen model loaded in %.3f s' % (time.perf_counter() - start))
+
+if __name__ == '__main__':
+    main()
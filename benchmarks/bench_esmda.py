@@ -0,0 +1,56 @@
+import argparse
+import time
+import numpy as np
+from HistoryMatching.ES_MDA import ESMDA_NP, ESMDA_TF
+
+
+# python -m benchmarks.bench_esmda --N_obs 2000 --N_m 500 --ensembles 100-500-1000
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark of the ES-MDA analysis step (numpy vs tensorflow kernel)",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--N_obs", type=int, default=2000,
+                        help="number of observations")
+    parser.add_argument("--N_m", type=int, default=500,
+                        help="size of the state (latent vector)")
+    parser.add_argument("--ensembles", type=str, default='100-500-1000',
+                        help="ensemble sizes")
+    parser.add_argument("--alp", type=int, default=4,
+                        help="number of assimilation steps (one call per step)")
+    parser.add_argument("--solver", type=str, default="data",
+                        help="ES-MDA solver ('data' or 'subspace')")
+    parser.add_argument("--dtype", type=str, default="float64",
+                        help="precision of the tensorflow kernel")
+    args = parser.parse_args()
+    return args
+
+
+def run(engine, m_ens, Z, prod_ens, alp):
+    times = []
+    for t in range(alp):
+        start = time.perf_counter()
+        result = engine.Analysis(m_ens, Z, prod_ens, alp)
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def main():
+    args = get_args()
+    rng = np.random.RandomState(0)
+    CD = 0.1 + rng.rand(args.N_obs)
+    Z = rng.rand(args.N_obs, 1)
+
+    print('%6s %12s %12s %12s %12s' % ('N_ens', 'numpy (s)', 'tf first (s)', 'tf (s)', 'max |diff|'))
+    for N_ens in [int(i) for i in args.ensembles.split('-')]:
+        m_ens = rng.randn(args.N_m, N_ens)
+        prod_ens = rng.randn(args.N_obs, N_ens)
+
+        result_np, times_np = run(ESMDA_NP(CD, seed=0, solver=args.solver), m_ens, Z, prod_ens, args.alp)
+        result_tf, times_tf = run(ESMDA_TF(CD, seed=0, solver=args.solver, dtype=args.dtype), m_ens, Z, prod_ens, args.alp)
+
+        # The first tensorflow call includes the tracing of the kernel
+        print('%6d %12.4f %12.4f %12.4f %12.2e' % (N_ens, np.mean(times_np), times_tf[0],
+              np.mean(times_tf[1:]), np.max(np.abs(result_np - result_tf))))
+
+if __name__ == '__main__':
+    main()
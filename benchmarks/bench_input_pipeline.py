@@ -0,0 +1,75 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.utils import to_categorical
+from Model.Utils import MPS_Generator, convert_to, compression_type
+
+
+# python -m benchmarks.bench_input_pipeline --path DataSet/MPS100/train.tfrecords --batch_size 64
+# Without --path a synthetic tfrecord is written in a temporary directory
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Throughput of the MPS_Generator input pipeline (samples/s)",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--path", type=str, default='',
+                        help="tfrecord file")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="batch size")
+    parser.add_argument("--batches", type=int, default=200,
+                        help="number of timed batches")
+    parser.add_argument("--samples", type=int, default=5000,
+                        help="number of synthetic samples")
+    parser.add_argument("--dim", type=int, default=100,
+                        help="size of the synthetic grid")
+    parser.add_argument("--encoding", type=str, default="onehot",
+                        help="storage of the synthetic facies ('onehot', 'index' or 'bits')")
+    parser.add_argument("--compression", type=str, default=None,
+                        help="compression of the synthetic tfrecord (None or 'GZIP')")
+    args = parser.parse_args()
+    return args
+
+
+def legacy_dataset(gen, path, batch_size):
+    # Pipeline before the rewrite: serial map per record, 42 elements shuffle after repeat, no prefetch
+    return tf.data.TFRecordDataset(path).map(gen.decode_example).repeat().shuffle(42).batch(batch_size)
+
+
+def throughput(dataset, batches, batch_size, index=None):
+    batch = dataset.make_one_shot_iterator().get_next()
+    if index is not None:
+        batch = batch[index]
+    sess = K.get_session()
+    sess.run(batch)
+    start = time.perf_counter()
+    for _ in range(batches):
+        sess.run(batch)
+    return batches*batch_size/(time.perf_counter() - start)
+
+
+def main():
+    args = get_args()
+    path = args.path
+    if not path:
+        data = (np.random.RandomState(0).rand(args.samples, args.dim, args.dim) > 0.7).astype(np.uint8)
+        directory = tempfile.mkdtemp()
+        path = convert_to(to_categorical(data, 2), 'bench', directory, args.encoding, args.compression)
+    print('%s: %.1f MB' % (path, os.path.getsize(path)/2**20))
+
+    gen = MPS_Generator(path, args.batch_size)
+    if gen.encoding == 'onehot' and not compression_type(path):
+        legacy = throughput(legacy_dataset(gen, path, args.batch_size), args.batches, args.batch_size, index=0)
+    else:
+        # The legacy pipeline only reads uncompressed one-hot records
+        legacy = np.nan
+    new = throughput(gen.dataset, args.batches, args.batch_size)
+    print('%12s %14s' % ('pipeline', 'samples/s'))
+    print('%12s %14.1f' % ('legacy', legacy))
+    print('%12s %14.1f' % ('new', new))
+    print('speedup %.2fx' % (new/legacy))
+
+if __name__ == '__main__':
+    main()
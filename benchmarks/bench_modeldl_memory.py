@@ -0,0 +1,61 @@
+import argparse
+import time
+import numpy as np
+from HistoryMatching.ModelDL import ModelDL
+
+
+# python -m benchmarks.bench_modeldl_memory --redePath Model/TrainModel/CVAE100 --model_dim 100-100-1
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Memory of consecutive ModelDL decode calls",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--redePath", type=str, required=True,
+                        help="network path (without _encoder/_decoder)")
+    parser.add_argument("--model_dim", type=str, default='100-100-1',
+                        help="dimension of the facies model")
+    parser.add_argument("--num_facies", type=int, default=2,
+                        help="number of facies")
+    parser.add_argument("--calls", type=int, default=1000,
+                        help="number of decode calls")
+    parser.add_argument("--num_ens", type=int, default=100,
+                        help="ensemble members per call")
+    parser.add_argument("--report", type=int, default=100,
+                        help="calls between memory reports")
+    args = parser.parse_args()
+    return args
+
+
+def rss_mb():
+    # Resident memory of the process (Linux)
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS'):
+                return int(line.split()[1])/1024.
+
+
+def main():
+    args = get_args()
+    model = {'redePath': args.redePath,
+             'PCA': False,
+             'IsGans': False,
+             'Model_Dim': tuple(int(i) for i in args.model_dim.split('-')),
+             'toCategorical': True,
+             'isTanh': False,
+             'NumFacies': args.num_facies}
+
+    with ModelDL(model) as network:
+        latent_dim = network.decoder.input_shape[-1]
+        m_x = np.random.randn(latent_dim, args.num_ens).astype('float32')
+        network.predict(m_x)
+
+        memory = [rss_mb()]
+        start = time.perf_counter()
+        for i in range(1, args.calls + 1):
+            network.predict(m_x)
+            if i % args.report == 0:
+                memory.append(rss_mb())
+                print('call %5d  RSS %8.1f MB  %.4f s/call' % (i, memory[-1], (time.perf_counter() - start)/i))
+    print('RSS growth after the first report: %.1f MB' % (memory[-1] - memory[1]))
+
+if __name__ == '__main__':
+    main()
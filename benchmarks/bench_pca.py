@@ -0,0 +1,60 @@
+import argparse
+import time
+import numpy as np
+from Model.UtilsPCA import ComputePCA
+
+
+# python -m benchmarks.bench_pca --data DataSet/MPS100.npy --Nc 70
+# Without --data a synthetic channelized-like binary dataset is used
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Timing and accuracy of the PCA builders (exact, randomized, incremental)",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--data", type=str, default='',
+                        help="npy file with the facies (samples, rows, cols[, 1])")
+    parser.add_argument("--samples", type=int, default=2000,
+                        help="number of synthetic samples")
+    parser.add_argument("--dim", type=int, default=60,
+                        help="size of the synthetic grid")
+    parser.add_argument("--Nc", type=int, default=70,
+                        help="number of components")
+    parser.add_argument("--methods", type=str, default='exact-randomized-incremental',
+                        help="methods to compare")
+    args = parser.parse_args()
+    return args
+
+
+def synthetic(samples, dim, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 1, dim)
+    phase, freq, width = rng.rand(3, samples, 1, 1)
+    rows = np.sin(2*np.pi*(1 + 2*freq)*x[None, None, :] + 2*np.pi*phase)
+    data = (np.abs(rows - (2*x[None, :, None] - 1)) < 0.2 + 0.3*width).astype(np.uint8)
+    return data[..., None]
+
+
+def main():
+    args = get_args()
+    data = np.load(args.data) if args.data else synthetic(args.samples, args.dim)
+    if data.ndim == 3:
+        data = data[..., None]
+    test = data.reshape(data.shape[0], -1)[:200].astype(float)
+
+    print('%12s %10s %16s %16s' % ('method', 'time (s)', 'reconstruction', 'subspace error'))
+    reference = None
+    for method in args.methods.split('-'):
+        start = time.perf_counter()
+        Us, Us_inv, const, nz, mean_, _ = ComputePCA(data, Nc=args.Nc, computeAll=False, method=method)
+        elapsed = time.perf_counter() - start
+
+        # Relative reconstruction error of the first samples and distance to the exact subspace
+        z = (1/const)*np.dot(Us_inv, (test - mean_).T)
+        error = np.linalg.norm(const*np.dot(Us, z).T + mean_ - test)/np.linalg.norm(test - mean_)
+        basis = np.linalg.qr(Us)[0]
+        if reference is None:
+            reference = basis
+        subspace = np.linalg.norm(basis - np.dot(reference, np.dot(reference.T, basis)), 2)
+        print('%12s %10.3f %16.4e %16.4e' % (method, elapsed, error, subspace))
+
+if __name__ == '__main__':
+    main()
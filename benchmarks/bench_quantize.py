@@ -0,0 +1,44 @@
+import argparse
+import numpy as np
+from HistoryMatching.ModelDL import ModelDL
+from HistoryMatching.Quantize import QuantizationReport
+
+
+# python -m benchmarks.bench_quantize --redePath Model/TrainModel/CVAE100 --model_dim 100-100-1 --N_latent 100
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Decoding time and facies agreement of the reduced precision decoders",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--redePath", type=str, required=True,
+                        help="network path (without _encoder/_decoder)")
+    parser.add_argument("--model_dim", type=str, default='100-100-1',
+                        help="dimension of the facies model")
+    parser.add_argument("--N_latent", type=int, default=100,
+                        help="size of the latent vector")
+    parser.add_argument("--NumFacies", type=int, default=2,
+                        help="number of facies")
+    parser.add_argument("--isTanh", action='store_true',
+                        help="decoder output in [-1, 1]")
+    parser.add_argument("--N_ens", type=int, default=1000,
+                        help="number of decoded members")
+    parser.add_argument("--precisions", type=str, default='float32-float16-int8',
+                        help="precisions to compare")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_args()
+    model = {'redePath': args.redePath, 'PCA': False, 'IsGans': False, 'toCategorical': True,
+             'Model_Dim': tuple(int(i) for i in args.model_dim.split('-')),
+             'NumFacies': args.NumFacies, 'isTanh': args.isTanh}
+    network = ModelDL(model)
+    latent = np.random.RandomState(0).randn(args.N_latent, args.N_ens)
+
+    report = QuantizationReport(network, latent, args.precisions.split('-'))
+    print('%10s %12s %12s %12s' % ('precision', 'time (s)', 'speedup', 'agreement'))
+    for precision, (elapsed, agreement) in report.items():
+        print('%10s %12.4f %12.2f %12.4f' % (precision, elapsed, report[args.precisions.split('-')[0]][0]/elapsed, agreement))
+
+if __name__ == '__main__':
+    main()
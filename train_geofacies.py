@@ -3,7 +3,7 @@ import numpy as np
 from pathlib import Path
 from Model.DCVAE import DCVAE, DCVAE_Style
 from Model.GeoGans import CycleGAN_MPS, GAN2D_MPS, AlphaGAN_MPS, WGAN2D_MPS
-from Model.Utils import MPS_Generator
+from Model.Utils import MPS_Generator, MPS_Memmap
 from keras.optimizers import RMSprop, Adam
 from sklearn.model_selection import train_test_split
 
@@ -12,7 +12,7 @@ def get_args():
     parser = argparse.ArgumentParser(description="train Geofacies Class",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--train_dataset_path", type=str, required=True,
-                        help="train dataset path (tfrecorfs)")
+                        help="train dataset path (tfrecorfs or .npy memory map)")
     parser.add_argument("--test_dataset_path", type=str, default=None,
                         help="test dataset path (tfrecorfs)")
     parser.add_argument("--filters", type=str, default='32-32-32',
@@ -63,12 +63,24 @@ def get_args():
                         help="Hiperparameter of AlphaGans and CycleGans networks")   
     parser.add_argument("--clip", type=float, default=0.05,
                         help="clip value for WGans-AE networks")                                                                                                                    
+    parser.add_argument("--streaming", action='store_true',
+                        help="GANs trained from batches of the dataset (converted per batch) instead of an array in memory, needs --test_dataset_path")
     args = parser.parse_args()
+    if args.streaming and args.test_dataset_path is None:
+        parser.error("--streaming needs --test_dataset_path (validation held out of the training stream)")
     return args
 
 
-def load_data_set(path_tfRecord, isArray=False, batch=4, isTanh=False):
+def load_data_set(path_tfRecord, isArray=False, batch=4, isTanh=False, isStream=False):
+    # isStream: the MPS_Generator / MPS_Memmap object itself (batch source of the GANs trainers)
+    if path_tfRecord.endswith('.npy'):
+        # Memory map: batches read from disk (keras Sequence), no second generator to load everything
+        gen_train = MPS_Memmap(path_tfRecord, batch, isTanh=isTanh)
+        x_train = gen_train.get_numpy_batch().astype('float32') if isArray else gen_train
+        return x_train, gen_train.num, gen_train.image_dim
     gen_train = MPS_Generator(path_tfRecord, batch)
+    if isStream:
+        return gen_train, gen_train.num, gen_train.image_dim
     if isArray:
         gen_train = MPS_Generator(path_tfRecord, gen_train.num)
         x_train = gen_train.get_numpy_batch().astype('float32')
@@ -89,6 +101,9 @@ def load_data_by_class(args,path):
         x_train,nt,image_dim = load_data_set(path,isArray=True)
         x_train = np.expand_dims(np.argmax(x_train,axis=-1),axis=-1)
         x_train = x_train*2-1        
+    elif args.streaming and args.model in ('AlphaGAN', 'GAN2D_AE', 'WGAN2D_AE'):
+        x_train,nt,image_dim= load_data_set(path,
+        batch=args.batch_size,isStream=True)
     elif args.model == 'AlphaGAN' or args.model == "CycleGAN" or args.model == "GAN2D_AE" or args.model == 'WGAN2D_AE':
         x_train,nt,image_dim= load_data_set(path,
         isArray=True,isTanh=True)